@@ -1,8 +1,25 @@
 #!/usr/bin/env python3
 
+import argparse
+import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
 import pathlib
+import random
+import re
+import resource
+import sys
+import threading
+import time
 
-import pandas as pd
+import flask
+import plotly
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
@@ -11,16 +28,238 @@ import plotly.graph_objs as go
 from dash_dangerously_set_inner_html import DangerouslySetInnerHTML
 from plotly.subplots import make_subplots
 
+# pandas is only imported where it is used, since a worker starting from
+# prebuilt artifacts does not need it until a request does (e.g. a custom date
+# range or the data API).
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import derived
+import metrics
+from atomicfile import atomic_write_bytes
+
 HERE = pathlib.Path(__file__).resolve().parent
 datafile = HERE / "data.csv"
+npyfile = HERE / "data.npy"
+artifactdir = HERE / "artifacts"
+
+
+# Pre-serialized document, served with an ETag (by default derived from the
+# content) and, to clients that accept it, brotli (if installed) or gzip
+# compressed.
+class Artifact:
+    def __init__(self, data, mimetype="application/json", etag=None):
+        self.data = data
+        self.mimetype = mimetype
+        self.etag = etag or hashlib.sha256(data).hexdigest()[:16]
+        self.encoded = {}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(data)
+        self.encoded["gzip"] = gzip.compress(data, 9)
+        # Tiny documents may not get any smaller.
+        for encoding, encoded in list(self.encoded.items()):
+            if len(encoded) >= len(data):
+                del self.encoded[encoding]
+
+    @classmethod
+    def from_obj(cls, obj, etag=None):
+        data = json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder).encode("utf-8")
+        return cls(data, etag=etag)
+
+    def response(self):
+        request = flask.request
+        flask.g.uncompressed_bytes = len(self.data)
+        if request.if_none_match.contains(self.etag):
+            response = flask.Response(status=304)
+        else:
+            encoding = next(
+                (e for e in self.encoded if e in request.accept_encodings), None
+            )
+            if encoding:
+                response = flask.Response(
+                    self.encoded[encoding], mimetype=self.mimetype
+                )
+                response.headers["Content-Encoding"] = encoding
+            else:
+                response = flask.Response(self.data, mimetype=self.mimetype)
+        response.set_etag(self.etag)
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+class Dash(dash.Dash):
+    layout_artifact = None
+
+    # Serve the layout serialized once by setup() instead of serializing
+    # app.layout on every request.
+    def serve_layout(self):
+        if self.layout_artifact is None:
+            return super().serve_layout()
+        return self.layout_artifact.response()
 
-app = dash.Dash(
+
+app = Dash(
     __name__,
     meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}],
 )
 app.title = "新型冠状病毒肺炎疫情历史数据"
 server = app.server
 
+# Request metrics (see metrics.py), enabled with NCOV_METRICS=1: latency per
+# route (and per callback output for Dash callbacks), response bytes before
+# and after compression, and worker memory, served at /metrics in the
+# Prometheus text format, along with the time setup() took. Metrics are kept
+# per worker process; the memory gauges are labeled with its pid.
+metrics_enabled = os.environ.get("NCOV_METRICS") == "1"
+if metrics_enabled:
+    metrics.enable()
+# Requests taking at least NCOV_SLOW_REQUEST seconds are passed to each of
+# slow_request_hooks as hook(environ, seconds, stats), where stats are the
+# pstats.Stats of the request if it was profiled, or None. A fraction
+# NCOV_PROFILE_RATE of requests is profiled (none by default).
+slow_request_seconds = float(os.environ.get("NCOV_SLOW_REQUEST", 1))
+profile_rate = float(os.environ.get("NCOV_PROFILE_RATE", 0))
+slow_request_hooks = []
+
+
+def log_slow_request(environ, seconds, stats):
+    request = f"{environ['REQUEST_METHOD']} {environ.get('PATH_INFO', '')}"
+    if stats is None:
+        server.logger.warning(f"slow request: {request} took {seconds:.3f}s")
+        return
+    buf = io.StringIO()
+    stats.stream = buf
+    stats.sort_stats("cumulative").print_stats(20)
+    server.logger.warning(
+        f"slow request: {request} took {seconds:.3f}s, profile:\n{buf.getvalue()}"
+    )
+
+
+slow_request_hooks.append(log_slow_request)
+
+
+# WSGI middleware timing requests, until the last byte of the response has
+# been handed to the server, and counting the bytes sent, i.e. after
+# compression. The route and uncompressed size are left in the environ by
+# record_response. Requests are only passed through untimed if there are no
+# metrics, profiling or slow request hooks.
+class RequestMetrics:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        # Only one request is profiled at a time.
+        self._profiling = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if not metrics_enabled and not profile_rate and not slow_request_hooks:
+            return self.wsgi_app(environ, start_response)
+        return self.run(environ, start_response)
+
+    def run(self, environ, start_response):
+        status = []
+
+        def start(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(" ", 1)[0]]
+            return start_response(status_line, headers, exc_info)
+
+        profiler = None
+        if (
+            profile_rate
+            and random.random() < profile_rate
+            and self._profiling.acquire(blocking=False)
+        ):
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start_time = time.perf_counter()
+        sent = 0
+        try:
+            body = self.wsgi_app(environ, start)
+            try:
+                for chunk in body:
+                    sent += len(chunk)
+                    yield chunk
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+        finally:
+            seconds = time.perf_counter() - start_time
+            stats = None
+            if profiler is not None:
+                profiler.disable()
+                self._profiling.release()
+                import pstats
+
+                stats = pstats.Stats(profiler)
+            labels = environ.get("ncov.route_labels", dict(route="unmatched"))
+            metrics.observe("request_seconds", seconds, **labels)
+            metrics.inc("requests_total", status=status[0] if status else "", **labels)
+            metrics.inc("response_bytes_total", sent, stage="sent", **labels)
+            metrics.inc(
+                "response_bytes_total",
+                environ.get("ncov.uncompressed_bytes", sent),
+                stage="uncompressed",
+                **labels,
+            )
+            if seconds >= slow_request_seconds:
+                for hook in slow_request_hooks:
+                    hook(environ, seconds, stats)
+
+
+server.wsgi_app = RequestMetrics(server.wsgi_app)
+
+
+# Runs before Flask-Compress (set up by Dash) compresses the response, since
+# after request functions run in the reverse order of registration.
+@server.after_request
+def record_response(response):
+    if not metrics_enabled:
+        return response
+    request = flask.request
+    labels = dict(route=request.url_rule.rule if request.url_rule else "unmatched")
+    if request.path.endswith("/_dash-update-component"):
+        payload = request.get_json(silent=True) or {}
+        labels["callback"] = payload.get("output", "")
+    if "uncompressed_bytes" in flask.g:
+        uncompressed = flask.g.uncompressed_bytes
+    elif response.direct_passthrough or response.is_streamed:
+        uncompressed = response.content_length or 0
+    else:
+        uncompressed = len(response.get_data())
+    request.environ["ncov.route_labels"] = labels
+    request.environ["ncov.uncompressed_bytes"] = uncompressed
+    return response
+
+
+def memory_usage():
+    # Peak resident set size, in KiB on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+    try:
+        with open("/proc/self/statm") as fp:
+            current = int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        current = None
+    return current, peak
+
+
+if metrics_enabled:
+
+    @server.route("/metrics")
+    def serve_metrics():
+        current, peak = memory_usage()
+        pid = os.getpid()
+        if current is not None:
+            metrics.set_gauge("worker_memory_bytes", current, pid=pid)
+        metrics.set_gauge("worker_memory_peak_bytes", peak, pid=pid)
+        return flask.Response(
+            metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+        )
+
 
 def category_scatter(df, category, color, stacked=False):
     return go.Scatter(
@@ -87,152 +326,262 @@ def plot_categories(
     return fig
 
 
-def setup():
-    df = pd.read_csv(datafile, index_col=0, parse_dates=[0])
-    df_display = df.rename(index=lambda d: d.strftime("%m-%d"))[::-1]
+confirmed_color = "#f06061"
+severe_color = "#8c0d0d"
+suspected_color = "#ffd661"
+cured_color = "#65b379"
+death_color = "#87878b"
+other_color1 = "#cc00ff"
+other_color2 = "#3399ff"
+other_color3 = "#9900ff"
 
-    df["重症比例"] = df["当前重症"] / df["当前确诊"]
-    df["治愈率"] = df["治愈"] / df["累计确诊"]
-    df["死亡率"] = df["死亡"] / df["累计确诊"]
-    df["非湖北重症比例"] = df["非湖北当前重症"] / df["非湖北当前确诊"]
-    df["非湖北治愈率"] = df["非湖北治愈"] / df["非湖北累计确诊"]
-    df["非湖北死亡率"] = df["非湖北死亡"] / df["非湖北累计确诊"]
-
-    national_columns = [col for col in df_display.columns if "湖北" not in col]
-    hubei_columns = [col for col in df_display.columns if col.startswith("湖北")]
-    outside_hubei_columns = [col for col in df_display.columns if col.startswith("非湖北")]
-    tables = [
-        (
-            label,
-            dt.DataTable(
-                columns=[{"name": "", "id": "category"}]
-                + [{"name": date, "id": date} for date in df_display.index],
-                data=[
-                    {"category": series.name, **series.to_dict()}
-                    for series in df_display[cols].to_dict("series").values()
-                ],
-                style_table={"overflowX": "scroll"},
-                style_header={
-                    "backgroundColor": "rgb(230, 230, 230)",
-                    "fontWeight": "bold",
-                },
-                style_cell_conditional=[
-                    {"if": {"column_id": "category"}, "textAlign": "center"}
-                ],
-                style_data_conditional=[
-                    {
-                        "if": {"row_index": "odd"},
-                        "backgroundColor": "rgb(248, 248, 248)",
-                    }
-                ],
-            ),
-        )
-        for label, cols in (
-            ("全国数据", national_columns),
-            ("湖北数据", hubei_columns),
-            ("非湖北数据", outside_hubei_columns),
-        )
-    ]
-
-    confirmed_color = "#f06061"
-    severe_color = "#8c0d0d"
-    suspected_color = "#ffd661"
-    cured_color = "#65b379"
-    death_color = "#87878b"
-    other_color1 = "#cc00ff"
-    other_color2 = "#3399ff"
-    other_color3 = "#9900ff"
+# (label, column filter) of each data table.
+TABLES = [
+    ("全国数据", lambda col: "湖北" not in col),
+    ("湖北数据", lambda col: col.startswith("湖北")),
+    ("非湖北数据", lambda col: col.startswith("非湖北")),
+]
 
-    figs1 = [
+# Groups of (label, plot_categories arguments) of figures.
+FIGURE_GROUPS = [
+    [
         (
             "确诊、重症及其比例、疑似走势",
-            plot_categories(
-                df,
-                ["累计确诊", "当前确诊", "当前重症", "当前疑似"],
-                [confirmed_color, other_color1, severe_color, suspected_color],
+            dict(
+                categories=["累计确诊", "当前确诊", "当前重症", "当前疑似"],
+                colors=[confirmed_color, other_color1, severe_color, suspected_color],
                 overlay_categories=["重症比例"],
                 overlay_colors=[severe_color],
             ),
         ),
         (
             "确诊加疑似走势",
-            plot_categories(
-                df, ["累计确诊", "当前疑似"], [confirmed_color, suspected_color], stacked=True
+            dict(
+                categories=["累计确诊", "当前疑似"],
+                colors=[confirmed_color, suspected_color],
+                stacked=True,
             ),
         ),
         (
             "治愈（率）、死亡（率）走势",
-            plot_categories(
-                df,
-                ["治愈", "死亡"],
-                [cured_color, death_color],
+            dict(
+                categories=["治愈", "死亡"],
+                colors=[cured_color, death_color],
                 overlay_categories=["治愈率", "死亡率"],
                 overlay_colors=[cured_color, death_color],
             ),
         ),
         (
             "每日新确诊、重症、疑似走势",
-            plot_categories(
-                df,
-                ["新确诊", "新重症", "新疑似"],
-                [confirmed_color, severe_color, suspected_color],
+            dict(
+                categories=["新确诊", "新重症", "新疑似"],
+                colors=[confirmed_color, severe_color, suspected_color],
             ),
         ),
-        ("每日新治愈、死亡走势", plot_categories(df, ["新治愈", "新死亡"], [cured_color, death_color])),
+        (
+            "每日新治愈、死亡走势",
+            dict(categories=["新治愈", "新死亡"], colors=[cured_color, death_color]),
+        ),
         (
             "追踪、观察走势",
-            plot_categories(df, ["累计追踪", "当前观察"], [other_color2, other_color3]),
+            dict(categories=["累计追踪", "当前观察"], colors=[other_color2, other_color3]),
         ),
-    ]
-
-    figs2 = [
+    ],
+    [
         (
             "非湖北确诊、重症及其比例、疑似走势",
-            plot_categories(
-                df,
-                ["非湖北累计确诊", "非湖北当前确诊", "非湖北当前重症", "非湖北当前疑似"],
-                [confirmed_color, other_color1, severe_color, suspected_color],
+            dict(
+                categories=["非湖北累计确诊", "非湖北当前确诊", "非湖北当前重症", "非湖北当前疑似"],
+                colors=[confirmed_color, other_color1, severe_color, suspected_color],
                 overlay_categories=["非湖北重症比例"],
                 overlay_colors=[severe_color],
             ),
         ),
         (
             "非湖北治愈（率）、死亡（率）走势",
-            plot_categories(
-                df,
-                ["非湖北治愈", "非湖北死亡"],
-                [cured_color, death_color],
+            dict(
+                categories=["非湖北治愈", "非湖北死亡"],
+                colors=[cured_color, death_color],
                 overlay_categories=["非湖北治愈率", "非湖北死亡率"],
                 overlay_colors=[cured_color, death_color],
             ),
         ),
         (
             "湖北内外累计确诊对比",
-            plot_categories(
-                df, ["湖北累计确诊", "非湖北累计确诊"], [severe_color, confirmed_color], stacked=True
+            dict(
+                categories=["湖北累计确诊", "非湖北累计确诊"],
+                colors=[severe_color, confirmed_color],
+                stacked=True,
             ),
         ),
-    ]
+    ],
+]
 
-    app.layout = html.Div(
-        children=[
-            html.H1(children="新型冠状病毒肺炎疫情历史数据"),
-            DangerouslySetInnerHTML(
-                """<p class="app-note app-note--center">数据主要来自<a href="http://www.nhc.gov.cn/yjb/pqt/new_list.shtml" target="_blank">国家卫生健康委员会卫生应急办公室网站</a></p>
-                <p class="app-note app-note--center">更多数据：<a href="https://news.qq.com/zt2020/page/feiyan.htm" target="_blank">腾讯新闻疫情实时追踪<a></p>"""
-            ),
+GRAPH_CONFIG = {
+    "displaylogo": False,
+    "modeBarButtonsToRemove": ["pan2d", "lasso2d", "toggleSpikelines"],
+}
+
+
+def tab_value(group_id, index):
+    return f"{group_id}-{index}"
+
+
+# Groups of figure tabs as (id, tab labels). The figure in a tab is only sent
+# when the tab is selected (see render_tab).
+FIGURE_TAB_GROUPS = [
+    (f"figs{i}", [label for label, _ in figs])
+    for i, figs in enumerate(FIGURE_GROUPS, 1)
+]
+
+# Number of dates (table columns) per page of the data table. Pages are
+# sliced on the server (see render_table_page), so the size of the table sent
+# to the client does not grow with the history.
+TABLE_PAGE_SIZE = 30
+
+# Maximum number of points per trace; longer series are aggregated on the
+# server before plotting (see downsample).
+MAX_PLOT_POINTS = 180
+
+DAILY_COLUMN = re.compile(r"^(非?湖北)?新")
+RATIO_COLUMNS = {
+    prefix + ratio for prefix in ("", "非湖北") for ratio, _, _ in derived.RATIOS
+}
+
+FIGURE_SPECS = {
+    tab_value(group_id, i): spec
+    for (group_id, _), figs in zip(FIGURE_TAB_GROUPS, FIGURE_GROUPS)
+    for i, (_, spec) in enumerate(figs)
+}
+
+
+# Return the data as a frame of nullable integer columns, memory mapped from
+# data.npy (written by the scraper export) unless it is missing or older than
+# data.csv.
+def load_data():
+    import pandas as pd
+
+    if derived.npy_is_current(npyfile, datafile):
+        return derived.load_npy(npyfile)
+    return pd.read_csv(datafile, index_col=0, parse_dates=[0]).astype("Int64")
+
+
+# Convert nullable integer columns for plotting and serialization: columns with
+# missing values become floats (with NaN), the others plain integers.
+def numpy_frame(df):
+    return df.astype(
+        {col: "float64" if df[col].isna().any() else "int64" for col in df.columns}
+    )
+
+
+def build_table():
+    return dt.DataTable(
+        id="table",
+        columns=[{"name": "", "id": "category"}],
+        data=[],
+        page_action="custom",
+        page_current=0,
+        page_count=1,
+        style_table={"overflowX": "scroll"},
+        style_header={"backgroundColor": "rgb(230, 230, 230)", "fontWeight": "bold"},
+        style_cell_conditional=[
+            {"if": {"column_id": "category"}, "textAlign": "center"}
+        ],
+        style_data_conditional=[
+            {"if": {"row_index": "odd"}, "backgroundColor": "rgb(248, 248, 248)"}
+        ],
+    )
+
+
+# Aggregate consecutive days into buckets so that at most max_points rows
+# remain. Daily counts (新*) are summed over each bucket, other stats take the
+# value of the last day of the bucket, which is also the bucket's label.
+def downsample(df, max_points=MAX_PLOT_POINTS):
+    if len(df) <= max_points:
+        return df
+    bucket_size = math.ceil(len(df) / max_points)
+    buckets = [i // bucket_size for i in range(len(df))]
+    stats = df.drop(columns=[col for col in df.columns if col in RATIO_COLUMNS])
+    aggregated = stats.groupby(buckets).agg(
+        {
+            col: (lambda s: s.sum(min_count=1)) if DAILY_COLUMN.match(col) else "last"
+            for col in stats.columns
+        }
+    )
+    aggregated.index = df.index.to_series().groupby(buckets).last()
+    return derived.add_ratios(aggregated)
+
+
+def build_graph(df, spec):
+    return dcc.Graph(
+        figure=plot_categories(downsample(df), **spec),
+        config=GRAPH_CONFIG,
+        className="app-plot",
+    )
+
+
+# Return (contents, tables), where contents maps figure tab values to the
+# serialized graphs, and tables maps table tab values to the dates and rows
+# ([category, *values]) of each table, newest date first. The data is loaded
+# unless given.
+def build_tab_contents(df=None):
+    df = numpy_frame(load_data() if df is None else df)
+    df_display = df.rename(index=lambda d: d.strftime("%m-%d"))[::-1]
+    derived.add_ratios(df)
+    contents = {}
+    for group_index, figs in enumerate(FIGURE_GROUPS, 1):
+        for i, (_, spec) in enumerate(figs):
+            contents[tab_value(f"figs{group_index}", i)] = build_graph(df, spec)
+    tables = {}
+    dates = list(df_display.index)
+    for i, (_, col_filter) in enumerate(TABLES):
+        cols = [col for col in df_display.columns if col_filter(col)]
+        tables[tab_value("tables", i)] = dict(
+            dates=dates, rows=[[col, *df_display[col].tolist()] for col in cols]
+        )
+    return json.loads(
+        json.dumps((contents, tables), cls=plotly.utils.PlotlyJSONEncoder)
+    )
+
+
+def tabs(group_id, labels, content):
+    return html.Div(
+        [
             dcc.Tabs(
-                [
+                id=f"{group_id}-tabs",
+                value=tab_value(group_id, 0),
+                children=[
                     dcc.Tab(
                         label=label,
-                        children=[table],
+                        value=tab_value(group_id, i),
                         className="app-tab",
                         selected_className="app-tab--selected",
                     )
-                    for label, table in tables
+                    for i, label in enumerate(labels)
                 ],
-                className="app-tabs-container",
             ),
+            content,
+        ],
+        className="app-tabs-container",
+    )
+
+
+# The layout only has the shells of the tabs and does not depend on the data.
+def build_layout():
+    tables_tabs = tabs("tables", [label for label, _ in TABLES], build_table())
+    figs_tabs = [
+        # Reserve the height of a plot while the contents are being loaded.
+        tabs(group_id, labels, html.Div(id=f"{group_id}-content", className="app-plot"))
+        for group_id, labels in FIGURE_TAB_GROUPS
+    ]
+    return html.Div(
+        children=[
+            html.H1(children="新型冠状病毒肺炎疫情历史数据"),
+            DangerouslySetInnerHTML(
+                """<p class="app-note app-note--center">数据主要来自<a href="http://www.nhc.gov.cn/yjb/pqt/new_list.shtml" target="_blank">国家卫生健康委员会卫生应急办公室网站</a></p>
+                <p class="app-note app-note--center">更多数据：<a href="https://news.qq.com/zt2020/page/feiyan.htm" target="_blank">腾讯新闻疫情实时追踪<a></p>"""
+            ),
+            tables_tabs,
             DangerouslySetInnerHTML(
                 """<p class="app-note">注1：2月6日前卫健委未直接发布“当前确诊”数据，表中数据系通过“当前确诊=累计确诊&minus;治愈&minus;死亡”计算补充。该计算方法与2月6日起卫健委直接发布的数据相符。</p>
                 <p class="app-note">注2：2月12日起卫健委未直接发布“湖北新重症”数据，表中数据系通过“湖北当前重症”较前日的增量计算补充。该计算方法与2月12日前直接发布的数据相符。</p>
@@ -240,43 +589,375 @@ def setup():
                 <p class="app-note">注4：非湖北数据仅限我国，系相应全国数据减去相应湖北数据所得。</p>
                 """
             ),
-            *[
-                dcc.Tabs(
-                    [
-                        dcc.Tab(
-                            label=label,
-                            children=[
-                                dcc.Graph(
-                                    figure=fig,
-                                    config={
-                                        "displaylogo": False,
-                                        "modeBarButtonsToRemove": [
-                                            "pan2d",
-                                            "lasso2d",
-                                            "toggleSpikelines",
-                                        ],
-                                    },
-                                    className="app-plot",
-                                )
-                            ],
-                            className="app-tab",
-                            selected_className="app-tab--selected",
-                        )
-                        for label, fig in figs
-                    ],
-                    className="app-tabs-container",
-                )
-                for figs in (figs1, figs2)
-            ],
+            html.Div(
+                dcc.DatePickerRange(
+                    id="date-range",
+                    display_format="YYYY-MM-DD",
+                    start_date_placeholder_text="起始日期",
+                    end_date_placeholder_text="结束日期",
+                    clearable=True,
+                ),
+                className="app-date-range",
+            ),
+            *figs_tabs,
         ],
         className="app-container",
     )
 
 
+# Tab contents for one version of data.csv, identified by key.
+class TabContents:
+    def __init__(self, key, contents, tables, df=None):
+        self.key = key
+        self.contents = contents
+        self.tables = tables
+        self._df = df
+
+    # The data frame is only needed to plot custom date ranges, so when the
+    # contents are loaded from an artifact it is only loaded on first use.
+    def frame(self):
+        if self._df is None:
+            self._df = load_data()
+        return self._df
+
+    @classmethod
+    def load(cls, path, key, df=None):
+        contents, tables = json.loads(gzip.decompress(path.read_bytes()))
+        return cls(key, contents, tables, df)
+
+    def save(self, path):
+        data = json.dumps((self.contents, self.tables)).encode("utf-8")
+        atomic_write_bytes(path, gzip.compress(data, 9))
+
+
+# The tab contents depend on the data and on the code building them, so both
+# go into the artifact key.
+def artifact_key():
+    h = hashlib.sha256()
+    for path in (datafile, HERE / "app.py", HERE / "derived.py"):
+        h.update(path.read_bytes())
+    return h.hexdigest()[:16]
+
+
+def load_or_build_tab_contents(key, df=None):
+    path = artifactdir / f"tabs-{key}.json.gz"
+    try:
+        return TabContents.load(path, key, df)
+    except FileNotFoundError:
+        pass
+    if df is None:
+        df = load_data()
+    tab_contents = TabContents(key, *build_tab_contents(df), df)
+    try:
+        artifactdir.mkdir(exist_ok=True)
+        tab_contents.save(path)
+        remove_stale_artifacts("tabs-*.json.gz", path)
+    except OSError as e:
+        server.logger.warning(f"cannot save tab contents artifact {path}: {e}")
+    return tab_contents
+
+
+# Load the serialized layout from artifactdir, or serialize app.layout (and try
+# to save it). The layout does not depend on the data, but is keyed like the
+# tab contents, so that a deployment ships a single version of both.
+def load_or_build_layout(key):
+    path = artifactdir / f"layout-{key}.json"
+    try:
+        return Artifact(path.read_bytes())
+    except FileNotFoundError:
+        pass
+    artifact = Artifact.from_obj(app.layout)
+    try:
+        artifactdir.mkdir(exist_ok=True)
+        atomic_write_bytes(path, artifact.data)
+        remove_stale_artifacts("layout-*.json", path)
+    except OSError as e:
+        server.logger.warning(f"cannot save layout artifact {path}: {e}")
+    return artifact
+
+
+def remove_stale_artifacts(pattern, current):
+    for stale in artifactdir.glob(pattern):
+        if stale != current:
+            stale.unlink()
+
+
+@functools.lru_cache(maxsize=256)
+def build_range_graph(tab_contents, value, start_date, end_date):
+    df = numpy_frame(tab_contents.frame()).loc[start_date:end_date]
+    graph = build_graph(derived.add_ratios(df), FIGURE_SPECS[value])
+    return json.loads(json.dumps(graph, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def render_tab(value, start_date, end_date):
+    tab_contents = app.data_version.tab_contents
+    if not start_date and not end_date:
+        return tab_contents.contents.get(value)
+    return build_range_graph(tab_contents, value, start_date, end_date)
+
+
+# Dash validates callbacks against app.layout when they are registered, so the
+# layout (which does not depend on the data) is set up front.
+app.layout = build_layout()
+
+for group_id, _ in FIGURE_TAB_GROUPS:
+    app.callback(
+        dash.dependencies.Output(f"{group_id}-content", "children"),
+        [
+            dash.dependencies.Input(f"{group_id}-tabs", "value"),
+            dash.dependencies.Input("date-range", "start_date"),
+            dash.dependencies.Input("date-range", "end_date"),
+        ],
+    )(render_tab)
+
+
+@app.callback(
+    [
+        dash.dependencies.Output("table", "columns"),
+        dash.dependencies.Output("table", "data"),
+        dash.dependencies.Output("table", "page_count"),
+    ],
+    [
+        dash.dependencies.Input("tables-tabs", "value"),
+        dash.dependencies.Input("table", "page_current"),
+    ],
+)
+def render_table_page(value, page_current):
+    table = app.data_version.tab_contents.tables[value]
+    dates = table["dates"]
+    page_count = max(1, math.ceil(len(dates) / TABLE_PAGE_SIZE))
+    start = min(page_current or 0, page_count - 1) * TABLE_PAGE_SIZE
+    end = start + TABLE_PAGE_SIZE
+    page_dates = dates[start:end]
+    columns = [{"name": "", "id": "category"}] + [
+        {"name": date, "id": date} for date in page_dates
+    ]
+    data = [
+        {"category": category, **dict(zip(page_dates, values[start:end]))}
+        for category, *values in table["rows"]
+    ]
+    return columns, data, page_count
+
+
+# Formats of the data API and their MIME types.
+API_FORMATS = {"json": "application/json", "csv": "text/csv; charset=utf-8"}
+
+
+# Index of one version of the data for the data API. The data frame is taken
+# from frame() on the first request, so that workers start without it (and
+# pandas). Responses for the whole series and for single days are built on
+# first request, and filtered responses are cached by api_artifact.
+class DataIndex:
+    def __init__(self, key, frame):
+        self.key = key
+        self._frame = frame
+        self._data = None
+        self._series = {}
+        self.days = {}
+
+    @staticmethod
+    def index(df):
+        return df, {date.strftime("%Y-%m-%d"): date for date in df.index}
+
+    # Loaded data and its dates are set together, so concurrent first
+    # requests at worst load the data twice.
+    def data(self):
+        if self._data is None:
+            self._data = self.index(self._frame())
+        return self._data
+
+    @property
+    def df(self):
+        return self.data()[0]
+
+    @property
+    def dates(self):
+        return self.data()[1]
+
+    def series(self, fmt):
+        try:
+            return self._series[fmt]
+        except KeyError:
+            artifact = self._series[fmt] = api_artifact(self, fmt)
+            return artifact
+
+    def day(self, date, fmt):
+        try:
+            return self.days[date, fmt]
+        except KeyError:
+            artifact = self.days[date, fmt] = api_artifact(self, fmt, date, date)
+            return artifact
+
+
+# Serialize the rows of df between start and end (inclusive, both optional)
+# and the given columns (all by default). JSON documents are columnar, with
+# missing values as null.
+@functools.lru_cache(maxsize=256)
+def api_artifact(index, fmt, start=None, end=None, columns=None):
+    df = index.df.loc[start:end, list(columns or index.df.columns)]
+    dates = [date.strftime("%Y-%m-%d") for date in df.index]
+    values = {
+        col: df[col].array.to_numpy(dtype=object, na_value=None).tolist()
+        for col in df.columns
+    }
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow([df.index.name, *df.columns])
+        writer.writerows(zip(dates, *values.values()))
+        data = buf.getvalue().encode("utf-8")
+    else:
+        document = dict(version=index.key, dates=dates, columns=values)
+        data = json.dumps(document, ensure_ascii=False).encode("utf-8")
+    return Artifact(data, mimetype=API_FORMATS[fmt])
+
+
+def api_error(status, message):
+    response = flask.jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+def parse_api_date(value):
+    try:
+        datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"invalid date {value!r}, expected YYYY-MM-DD")
+    return value
+
+
+# Return (fmt, columns) from the query string; columns is None if all columns
+# are selected.
+def parse_api_args(index):
+    args = flask.request.args
+    fmt = args.get("format", "json")
+    if fmt not in API_FORMATS:
+        raise ValueError(f"invalid format {fmt!r}, expected one of {list(API_FORMATS)}")
+    if "columns" not in args:
+        return fmt, None
+    columns = tuple(col for col in args["columns"].split(",") if col)
+    for col in columns:
+        if col not in index.df.columns:
+            raise ValueError(f"unknown column {col!r}")
+    return fmt, columns
+
+
+# /api/v1/series[?start=YYYY-MM-DD][&end=YYYY-MM-DD][&columns=a,b][&format=csv]
+@server.route("/api/v1/series")
+def api_series():
+    index = app.data_version.data_index
+    try:
+        fmt, columns = parse_api_args(index)
+        start = end = None
+        if "start" in flask.request.args:
+            start = parse_api_date(flask.request.args["start"])
+        if "end" in flask.request.args:
+            end = parse_api_date(flask.request.args["end"])
+    except ValueError as e:
+        return api_error(400, str(e))
+    if start is None and end is None and columns is None:
+        return index.series(fmt).response()
+    return api_artifact(index, fmt, start, end, columns).response()
+
+
+# /api/v1/day/YYYY-MM-DD[?columns=a,b][&format=csv]
+@server.route("/api/v1/day/<date>")
+def api_day(date):
+    index = app.data_version.data_index
+    try:
+        fmt, columns = parse_api_args(index)
+        parse_api_date(date)
+    except ValueError as e:
+        return api_error(400, str(e))
+    if date not in index.dates:
+        return api_error(404, f"no data for {date}")
+    if columns is None:
+        return index.day(date, fmt).response()
+    return api_artifact(index, fmt, date, date, columns).response()
+
+
+# Tab contents and data API index of one version of data.csv, identified by
+# key, swapped in as a whole on reload. Both share the data frame of the tab
+# contents, which is loaded when first needed unless given.
+class DataVersion:
+    def __init__(self, key, df=None):
+        self.key = key
+        self.tab_contents = load_or_build_tab_contents(key, df)
+        self.data_index = DataIndex(key, self.tab_contents.frame)
+
+
+# Load the serialized layout and the tab contents for the current data.csv
+# from artifactdir, or build them (and try to save them for other workers and
+# later starts). With the artifacts in place (see make gcp), pandas is not
+# imported, and the data is only loaded when a request needs it.
+def setup():
+    key = artifact_key()
+    with metrics.span("layout_load"):
+        app.layout_artifact = load_or_build_layout(key)
+    with metrics.span("tab_contents_load"):
+        app.data_version = DataVersion(key)
+
+
+# Watch data.csv and swap in a new data version when it changes. It is built in
+# this thread and replaces the old one with a single assignment, so requests
+# are never blocked and never see partially built contents, or tab contents
+# and a data index of different versions.
+class DataWatcher(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name="data-watcher", daemon=True)
+        self.interval = interval
+        self._stat = self.data_stat()
+
+    @staticmethod
+    def data_stat():
+        try:
+            stat = datafile.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                server.logger.exception(f"failed to reload {datafile.name}")
+
+    def check(self):
+        stat = self.data_stat()
+        if stat is None or stat == self._stat:
+            return
+        key = artifact_key()
+        if key != app.data_version.key:
+            server.logger.info(f"{datafile.name} changed, reloading")
+            app.data_version = DataVersion(key, load_data())
+        # Only recorded once the new data is in place, so that a failed reload
+        # is retried on the next check.
+        self._stat = stat
+
+
 setup()
 
+# Seconds between checks for a new data.csv; 0 disables reloading.
+reload_interval = float(os.environ.get("NCOV_RELOAD_INTERVAL", 60))
+if reload_interval > 0:
+    DataWatcher(reload_interval).start()
+
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help=f"only build the tab contents artifact in {artifactdir.name}/ "
+        f"(and {npyfile.name} if it is out of date) and exit",
+    )
+    args = parser.parse_args()
+    if args.build:
+        if not derived.npy_is_current(npyfile, datafile):
+            derived.save_npy(load_data(), npyfile)
+        return
     app.run_server(host="0.0.0.0", debug=True)
 
 
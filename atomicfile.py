@@ -0,0 +1,45 @@
+# Atomic file writes.
+#
+# Files are written to a uniquely named temporary file in the same directory
+# and renamed over the target, so readers see either the old or the new file
+# in full, and processes writing the same file at once (e.g. workers building
+# the same artifact) do not trip over each other's temporary files.
+
+import contextlib
+import os
+import tempfile
+
+
+# Open a temporary file next to path for writing in mode ("w" or "wb") and
+# move it to path once the block exits without an exception; otherwise the
+# temporary file is removed and path is left untouched.
+@contextlib.contextmanager
+def atomic_open(path, mode="w", encoding=None):
+    path = os.fspath(path)
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=directory or ".", prefix=f".{name}.")
+    try:
+        with open(fd, mode, encoding=encoding) as fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+        try:
+            mode_bits = os.stat(path).st_mode
+        except FileNotFoundError:
+            mode_bits = 0o644
+        os.chmod(tmp, mode_bits)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+def atomic_write_bytes(path, data):
+    with atomic_open(path, "wb") as fp:
+        fp.write(data)
+
+
+def atomic_write_text(path, text, encoding=None):
+    with atomic_open(path, "w", encoding=encoding) as fp:
+        fp.write(text)
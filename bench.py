@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+
+# Benchmarks.
+#
+# load: bulk-load synthetic days (an article and its stats each) into a fresh
+# database, the way scraper.main stores new articles (PRAGMAS, batched
+# inserts in one transaction), and for comparison the way it used to, with
+# autocommitted inserts of each article and its stats under SQLite's default
+# pragmas.
+#
+# suite: time the data pipeline on synthetic reports at multiples of the
+# BASE_DAYS days of data.csv: extraction of stats from NHC and Hubei report
+# bodies, export of data.db, loading the exported data in the app (from CSV
+# and from data.npy), building the figures and tables, and app setup from a
+# prebuilt artifact. Each benchmark is run --repeat times (reporting the
+# fastest and median run), then once more under tracemalloc for its peak
+# memory. Results can be saved as a baseline and later runs compared to it.
+#
+# startup: time importing the app (which sets it up) in fresh interpreters,
+# as a worker does on a cold start, and break the import time down by module
+# with python -X importtime.
+
+import argparse
+import contextlib
+import datetime
+import gc
+import importlib
+import json
+import os
+import pathlib
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import hb_scraper
+import scraper
+from scraper import (
+    init_database,
+    database,
+    stat_rows,
+    save_articles,
+    save_stats,
+    Stat,
+)
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+# Days in data.csv when the suite was written.
+BASE_DAYS = 53
+DEFAULT_SCALES = [10, 100, 1000]
+DEFAULT_BASELINE = HERE / "bench-baseline.json"
+# Relative slowdown against the baseline reported as a regression, unless
+# it is below MIN_REGRESSION seconds (timer noise on the shortest runs).
+DEFAULT_TOLERANCE = 0.25
+MIN_REGRESSION = 0.005
+
+NHC_TITLE = "截至{m}月{d}日24时新型冠状病毒肺炎疫情最新情况"
+NHC_BODY = (
+    "{m}月{d}日0—24时，31个省（自治区、直辖市）和新疆生产建设兵团报告"
+    "新增确诊病例{new_confirmed}例（湖北省{hb_new_confirmed}例），"
+    "新增重症病例{new_severe}例（湖北省{hb_new_severe}例），"
+    "新增死亡病例{new_death}例（湖北省{hb_new_death}例），"
+    "新增疑似病例{new_suspected}例（湖北省{hb_new_suspected}例）。\n"
+    "当日新增治愈出院病例{new_cured}例（湖北省{hb_new_cured}例），"
+    "解除医学观察的密切接触者{new_lifted}人。\n"
+    "截至{m}月{d}日24时，据31个省（自治区、直辖市）和新疆生产建设兵团报告，"
+    "现有确诊病例{remaining_confirmed}例（其中重症病例{remaining_severe}例），"
+    "累计治愈出院病例{cured}例，累计死亡病例{death}例，"
+    "累计报告确诊病例{total_confirmed}例，现有疑似病例{remaining_suspected}例。"
+    "累计追踪到密切接触者{total_tracked}人，"
+    "尚在医学观察的密切接触者{remaining_quarantined}人。\n"
+    "湖北新增确诊病例{hb_new_confirmed}例（武汉{wuhan_new_confirmed}例），"
+    "新增治愈出院病例{hb_new_cured}例，新增死亡病例{hb_new_death}例，"
+    "现有确诊病例{hb_remaining_confirmed}例（其中重症病例{hb_remaining_severe}例），"
+    "累计治愈出院病例{hb_cured}例，累计死亡病例{hb_death}例，"
+    "累计确诊病例{hb_total_confirmed}例，现有疑似病例{hb_remaining_suspected}例。\n"
+    "（注：香港特别行政区、澳门特别行政区和台湾地区通报的病例不计入上述数据。）"
+)
+HB_BODY = (
+    "2020年{m}月{d}日0—24时，全省新增新冠肺炎病例{hb_new_confirmed}例，"
+    "其中：武汉市{wuhan_new_confirmed}例。"
+    "全省新增病亡{hb_new_death}例，新增出院{hb_new_cured}例。\n"
+    "截至{m}月{d}日24时，全省累计报告新冠肺炎病例{hb_total_confirmed}例。"
+    "累计治愈出院{hb_cured}例，累计病亡{hb_death}例，"
+    "现有确诊病例在院治疗{hb_remaining_confirmed}例，"
+    "其中：重症{hb_severe}例，危重症{hb_critical}例。"
+    "现有疑似病例{hb_remaining_suspected}例。\n"
+    "湖北省卫生健康委员会"
+)
+
+
+# Return n synthetic days from 2020-01-20 on, as dicts of the date, the stats
+# (as parsed from the reports) and the NHC (title, body) and Hubei body
+# reporting them. Cumulative stats grow from day to day like the real ones.
+def synthetic_reports(n, seed=0):
+    rnd = random.Random(seed)
+    start = datetime.date(2020, 1, 20)
+    cn = dict.fromkeys(["total_confirmed", "cured", "death", "total_tracked"], 0)
+    hb = dict.fromkeys(["total_confirmed", "cured", "death", "severe"], 0)
+    reports = []
+    for i in range(n):
+        date = start + datetime.timedelta(days=i)
+        # Each day adds new cases in and outside Hubei, and closes some of the
+        # remaining ones.
+        new = {}
+        for region, stats, scale in (("hb", hb, 1), ("not_hb", cn, 3)):
+            remaining = stats["total_confirmed"] - stats["cured"] - stats["death"]
+            new[region] = dict(
+                new_confirmed=rnd.randint(10, 300) * scale // 3 + rnd.randint(0, 50),
+                new_cured=rnd.randint(0, remaining // 10),
+                new_death=rnd.randint(0, remaining // 200),
+                new_severe=rnd.randint(0, 40) * scale // 3,
+                new_suspected=rnd.randint(10, 200) * scale // 3,
+            )
+        for metric in ("total_confirmed", "cured", "death"):
+            new_metric = "new_" + metric.split("_")[-1]
+            hb[metric] += new["hb"][new_metric]
+            cn[metric] += new["hb"][new_metric] + new["not_hb"][new_metric]
+        hb["severe"] += new["hb"]["new_severe"] - rnd.randint(0, hb["severe"] // 20)
+        new_lifted = rnd.randint(100, 3000)
+        cn["total_tracked"] += new_lifted + rnd.randint(0, 5000)
+        hb_remaining = hb["total_confirmed"] - hb["cured"] - hb["death"]
+        hb_severe = min(hb["severe"], hb_remaining)
+        hb_critical = rnd.randint(0, hb_severe // 4)
+        hb_suspected = rnd.randint(1000, 10000)
+        data = dict(date=date)
+        for metric in new["hb"]:
+            data[metric] = new["hb"][metric] + new["not_hb"][metric]
+            data[f"hb_{metric}"] = new["hb"][metric]
+        data.update(
+            total_confirmed=cn["total_confirmed"],
+            cured=cn["cured"],
+            death=cn["death"],
+            remaining_confirmed=cn["total_confirmed"] - cn["cured"] - cn["death"],
+            remaining_severe=hb_severe + rnd.randint(0, 500),
+            remaining_suspected=hb_suspected + rnd.randint(0, 3000),
+            total_tracked=cn["total_tracked"],
+            new_lifted=new_lifted,
+            remaining_quarantined=rnd.randint(10000, 200000),
+            hb_total_confirmed=hb["total_confirmed"],
+            hb_cured=hb["cured"],
+            hb_death=hb["death"],
+            hb_remaining_confirmed=hb_remaining,
+            hb_remaining_severe=hb_severe,
+            hb_remaining_suspected=hb_suspected,
+        )
+        values = dict(
+            data,
+            m=date.month,
+            d=date.day,
+            wuhan_new_confirmed=data["hb_new_confirmed"] * 2 // 3,
+            hb_severe=hb_severe - hb_critical,
+            hb_critical=hb_critical,
+        )
+        reports.append(
+            dict(
+                date=date,
+                data=data,
+                nhc=(NHC_TITLE.format(**values), NHC_BODY.format(**values)),
+                hb=HB_BODY.format(**values),
+            )
+        )
+    return reports
+
+
+# Return (entry, stat rows) of each of reports (see synthetic_reports), as
+# stored by scraper.main.
+def stored_days(reports):
+    return [
+        (
+            dict(
+                date=report["date"],
+                article_url=f"http://www.nhc.gov.cn/yjb/s7860/{i}.shtml",
+                article_title=report["nhc"][0],
+                article_body=report["nhc"][1],
+            ),
+            stat_rows(report["date"], report["data"]),
+        )
+        for i, report in enumerate(reports)
+    ]
+
+
+def load_per_article(days):
+    fields = [Stat.date, Stat.region, Stat.metric, Stat.value]
+    for entry, rows in days:
+        save_articles([entry])
+        Stat.insert_many(rows, fields=fields).on_conflict_replace().execute()
+
+
+def load_batched(days):
+    with database.atomic():
+        save_articles([entry for entry, _ in days])
+        save_stats([row for _, rows in days for row in rows])
+
+
+def bench_load(args):
+    days = stored_days(synthetic_reports(args.rows))
+    nstats = sum(len(rows) for _, rows in days)
+    modes = [("batched", load_batched, None)]
+    if not args.skip_per_article:
+        modes.append(("per article", load_per_article, {}))
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        for name, load, pragmas in modes:
+            path = pathlib.Path(tmpdir) / f"{name.replace(' ', '-')}.db"
+            if pragmas is None:
+                init_database(path)
+            else:
+                init_database(path, pragmas=pragmas)
+            start = time.perf_counter()
+            load(days)
+            elapsed = time.perf_counter() - start
+            database.close()
+            print(
+                f"{name:>11}: {len(days)} days, {nstats} stats in {elapsed:.2f}s "
+                f"({len(days) / elapsed:.0f} days/s)"
+            )
+
+
+# Return the fastest and median wall time of repeat runs of func, and the peak
+# memory allocated by one more run traced by tracemalloc (which slows it
+# down too much to time it in the same run).
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(min=min(times), median=statistics.median(times), peak=peak)
+
+
+# The parsers print what they find; keep that out of the timings and output.
+def quietly(func, *args):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return func(*args)
+
+
+# Yield (name, func) of the benchmarks of a scale, running in workdir. The
+# exported files and the artifacts of the app are redirected there.
+def suite_benchmarks(app, reports, workdir):
+    scraper.datafile = app.datafile = workdir / "data.csv"
+    scraper.manifestfile = workdir / "data.manifest.json"
+    scraper.npyfile = workdir / "data.npy"
+    app.artifactdir = workdir / "artifacts"
+
+    def extract_nhc():
+        for title, body in (report["nhc"] for report in reports):
+            quietly(scraper.parse_article, title, body)
+
+    def extract_hb():
+        for body in (report["hb"] for report in reports):
+            quietly(hb_scraper.parse_article, body)
+
+    yield "extract nhc", extract_nhc
+    yield "extract hb", extract_hb
+
+    init_database(workdir / "data.db")
+    load_batched(stored_days(reports))
+    yield "export", lambda: scraper.export_csv(incremental=False)
+    database.close()
+
+    app.npyfile = workdir / "missing.npy"
+    yield "load csv", app.load_data
+    app.npyfile = scraper.npyfile
+    yield "load npy", app.load_data
+    yield "build figures", app.build_tab_contents
+    app.setup()
+    yield "app setup", app.setup
+
+
+def bench_suite(args):
+    # Importing the app sets it up for the data.csv of the repository, which
+    # builds its artifact if there is none yet; it is not reloaded.
+    os.environ["NCOV_RELOAD_INTERVAL"] = "0"
+    import app
+
+    # Keep the deferred pandas import of the app and derived out of the timings.
+    importlib.import_module("pandas")
+
+    logging_level = scraper.logger.level
+    # Export logs every run.
+    scraper.logger.setLevel("WARNING")
+    results = {}
+    try:
+        for scale in args.scales:
+            ndays = scale * BASE_DAYS
+            reports = synthetic_reports(ndays, seed=args.seed)
+            with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+                benchmarks = suite_benchmarks(app, reports, pathlib.Path(tmpdir))
+                for name, func in benchmarks:
+                    key = f"{name} ({scale}x)"
+                    result = results[key] = measure(func, args.repeat)
+                    print(
+                        f"{key:<24} {ndays:>6} days  "
+                        f"min {result['min']:8.3f}s  "
+                        f"median {result['median']:8.3f}s  "
+                        f"peak {result['peak'] / 2 ** 20:8.1f}MiB",
+                        flush=True,
+                    )
+    finally:
+        scraper.logger.setLevel(logging_level)
+
+    if args.save_baseline:
+        baseline = dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            repeat=args.repeat,
+            results=results,
+        )
+        args.baseline.write_text(json.dumps(baseline, indent=2) + "\n")
+        print(f"baseline saved to {args.baseline}")
+    elif args.baseline.exists():
+        if not compare(results, args.baseline, args.tolerance):
+            sys.exit(1)
+
+
+# Print the results against those of the baseline file, and return whether
+# none of the benchmarks are slower than tolerance allows.
+def compare(results, path, tolerance):
+    baseline = json.loads(path.read_text())
+    print(f"\ncompared to {path.name} ({baseline['platform']}):")
+    ok = True
+    for key, result in results.items():
+        if key not in baseline["results"]:
+            continue
+        base = baseline["results"][key]
+        ratio = result["min"] / base["min"]
+        peak_ratio = result["peak"] / base["peak"] if base["peak"] else 1
+        regressed = (
+            ratio > 1 + tolerance and result["min"] - base["min"] > MIN_REGRESSION
+        )
+        ok = ok and not regressed
+        print(
+            f"{key:<24} time {ratio:6.2f}x  peak {peak_ratio:6.2f}x"
+            + ("  REGRESSION" if regressed else "")
+        )
+    return ok
+
+
+STARTUP_CODE = (
+    "import time; start = time.perf_counter(); import app; "
+    "print(time.perf_counter() - start)"
+)
+IMPORTTIME_LINE = re.compile(r"^import time:\s*(\d+) \|\s*(\d+) \| ( *)(\S+)$")
+
+
+def run_app_import(*options):
+    env = dict(os.environ, NCOV_RELOAD_INTERVAL="0")
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, *options, "-c", STARTUP_CODE],
+        cwd=HERE,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return time.perf_counter() - start, float(result.stdout), result.stderr
+
+
+# Return (self, cumulative) import times in seconds of app and of the modules
+# it imports directly, from the output of python -X importtime. Modules
+# already imported by the interpreter (or by an earlier import) are not
+# listed.
+def import_breakdown(importtime_output):
+    modules = []
+    for line in importtime_output.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if m:
+            own, cumulative, indent, name = m.groups()
+            modules.append((len(indent) // 2, name, int(own), int(cumulative)))
+    app_depth = next(depth for depth, name, _, _ in modules if name == "app")
+    return {
+        name: (own / 1e6, cumulative / 1e6)
+        for depth, name, own, cumulative in modules
+        if depth == app_depth + 1 or name == "app"
+    }
+
+
+def bench_startup(args):
+    # The first run builds the artifacts if needed, as a deployment does.
+    run_app_import()
+    process_times = []
+    import_times = []
+    for _ in range(args.repeat):
+        process_time, import_time, _ = run_app_import()
+        process_times.append(process_time)
+        import_times.append(import_time)
+    print(
+        f"process: min {min(process_times):.3f}s  "
+        f"median {statistics.median(process_times):.3f}s"
+    )
+    print(
+        f"import app: min {min(import_times):.3f}s  "
+        f"median {statistics.median(import_times):.3f}s"
+    )
+
+    _, _, stderr = run_app_import("-X", "importtime")
+    breakdown = import_breakdown(stderr)
+    own, total = breakdown.pop("app")
+    print(f"\nimport app: {total:.3f}s, of which")
+    print(f"{own:8.3f}s  app itself (including setup)")
+    by_time = sorted(breakdown.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (_, cumulative) in by_time[: args.top]:
+        print(f"{cumulative:8.3f}s  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+    load_parser = subparsers.add_parser("load", help="bulk-load synthetic days")
+    load_parser.add_argument(
+        "-n", "--rows", type=int, default=10000, help="number of days (default: 10000)"
+    )
+    load_parser.add_argument(
+        "--skip-per-article",
+        action="store_true",
+        help="only run the batched load (the per-article one is slow)",
+    )
+    load_parser.add_argument(
+        "--dir", help="directory for the temporary databases (default: system temp)"
+    )
+    load_parser.set_defaults(func=bench_load)
+    suite_parser = subparsers.add_parser(
+        "suite", help="time extraction, export, data loading and figure building"
+    )
+    suite_parser.add_argument(
+        "-s",
+        "--scale",
+        dest="scales",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SCALES,
+        help=f"numbers of days, as multiples of {BASE_DAYS} "
+        f"(default: {' '.join(map(str, DEFAULT_SCALES))})",
+    )
+    suite_parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="timed runs (default: 3)"
+    )
+    suite_parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the synthetic data (default: 0)"
+    )
+    suite_parser.add_argument(
+        "--baseline",
+        type=pathlib.Path,
+        default=DEFAULT_BASELINE,
+        help="baseline file to compare to (default: %(default)s)",
+    )
+    suite_parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save the results as the baseline instead of comparing to it",
+    )
+    suite_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="relative slowdown reported as a regression, failing the run "
+        f"(default: {DEFAULT_TOLERANCE})",
+    )
+    suite_parser.add_argument(
+        "--dir", help="directory for the temporary files (default: system temp)"
+    )
+    suite_parser.set_defaults(func=bench_suite)
+    startup_parser = subparsers.add_parser(
+        "startup", help="time the app's import and setup in fresh interpreters"
+    )
+    startup_parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="timed runs (default: 5)"
+    )
+    startup_parser.add_argument(
+        "--top",
+        type=int,
+        default=15,
+        help="number of imports in the breakdown (default: 15)",
+    )
+    startup_parser.set_defaults(func=bench_startup)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# Columnar derivation of calculated columns.
+#
+# The whole table is handled as one DataFrame of nullable integer columns
+# indexed by date, so each derived column is a single vectorized operation
+# (with missing values propagating) rather than per-row attribute lookups.
+# Used by both the CSV export in scraper.py and the web app.
+#
+# Besides data.csv, the export writes the same table to data.npy (see
+# save_npy), which the app loads without parsing text.
+#
+# pandas and NumPy are imported by the functions using them, so that the app
+# can import the registry below and start without them.
+
+from atomicfile import atomic_open
+
+# Stats are stored as (date, region, metric, value) rows (see Stat in
+# scraper.py) and pivoted into a column per (region, metric) field on demand.
+# Fields of the whole country are named after the metric, fields of other
+# regions are prefixed by the region, e.g. hb_total_confirmed.
+NATIONAL = "cn"
+# Regions and the prefixes of their column labels.
+REGIONS = {NATIONAL: "", "hb": "湖北"}
+# Regions for which stats of the rest of the country are derived, as fields
+# named not_<region>_<metric>.
+OUTSIDE_REGIONS = ["hb"]
+
+# Metrics reported both nationally and for the other regions.
+REGIONAL_METRICS = [
+    "total_confirmed",
+    "remaining_confirmed",
+    "remaining_severe",
+    "remaining_suspected",
+    "cured",
+    "death",
+    "new_confirmed",
+    "new_severe",
+    "new_suspected",
+    "new_cured",
+    "new_death",
+]
+NATIONAL_ONLY_METRICS = ["total_tracked", "new_lifted", "remaining_quarantined"]
+METRICS = REGIONAL_METRICS + NATIONAL_ONLY_METRICS
+
+
+def field(region, metric):
+    return metric if region == NATIONAL else f"{region}_{metric}"
+
+
+def split_field(name):
+    region, _, metric = name.partition("_")
+    if region in REGIONS and metric in METRICS:
+        return region, metric
+    return NATIONAL, name
+
+
+def region_fields(region):
+    metrics = METRICS if region == NATIONAL else REGIONAL_METRICS
+    return [field(region, metric) for metric in metrics]
+
+
+RAW_FIELDS = [name for region in REGIONS for name in region_fields(region)]
+OUTSIDE_FIELDS = [
+    f"not_{name}" for region in OUTSIDE_REGIONS for name in region_fields(region)
+]
+CSV_FIELDS = RAW_FIELDS + OUTSIDE_FIELDS
+
+LABELS = {
+    "total_confirmed": "累计确诊",
+    "remaining_confirmed": "当前确诊",
+    "remaining_severe": "当前重症",
+    "remaining_suspected": "当前疑似",
+    "cured": "治愈",
+    "death": "死亡",
+    "new_confirmed": "新确诊",
+    "new_severe": "新重症",
+    "new_suspected": "新疑似",
+    "new_cured": "新治愈",
+    "new_death": "新死亡",
+    "total_tracked": "累计追踪",
+    "new_lifted": "新排除",
+    "remaining_quarantined": "当前观察",
+}
+
+
+def label(name):
+    if name.startswith("not_"):
+        return "非" + label(name[4:])
+    region, metric = split_field(name)
+    return REGIONS[region] + LABELS[metric]
+
+
+CSV_HEADER = ["日期"] + [label(field) for field in CSV_FIELDS]
+
+# Suffix of the field holding the missing value mask of each column in data.npy.
+MASK_SUFFIX = ":mask"
+
+# (ratio, numerator, denominator) column labels; the same ratios are also
+# computed for outside Hubei.
+RATIOS = [
+    ("重症比例", "当前重症", "当前确诊"),
+    ("治愈率", "治愈", "累计确诊"),
+    ("死亡率", "死亡", "累计确诊"),
+]
+
+
+# Pivot (date, region, metric, value) rows into a frame with a nullable
+# integer column for each of fields (by default RAW_FIELDS), indexed by date.
+def pivot(records, fields=None):
+    import pandas as pd
+
+    stats = pd.DataFrame.from_records(
+        list(records), columns=["date", "region", "metric", "value"]
+    )
+    frame = stats.set_index(["date", "region", "metric"])["value"].unstack(
+        ["region", "metric"]
+    )
+    frame.columns = [field(region, metric) for region, metric in frame.columns]
+    frame = frame.reindex(columns=RAW_FIELDS if fields is None else fields)
+    frame.index = pd.to_datetime(frame.index)
+    return frame.sort_index().astype("Int64")
+
+
+# Return a frame of the stats of the country outside region, as not_<region>_*
+# columns.
+def outside(frame, region):
+    import pandas as pd
+
+    return pd.DataFrame(
+        {
+            f"not_{field(region, metric)}": frame[metric] - frame[field(region, metric)]
+            for metric in REGIONAL_METRICS
+        },
+        index=frame.index,
+    )
+
+
+# Return a frame of CSV_FIELDS, filling in stats missing from official reports
+# where they can be calculated and adding outside-Hubei columns.
+def derive(frame):
+    import pandas as pd
+
+    frame = frame.copy()
+    # Calculate remaining confirmed when official report does not include
+    # this stat.
+    frame["remaining_confirmed"] = frame["remaining_confirmed"].fillna(
+        frame["total_confirmed"] - frame["cured"] - frame["death"]
+    )
+    # Calculate new severe cases in Hubei when official report does not
+    # include this stat, from the previous day's remaining severe cases.
+    prev_day_hb_remaining_severe = (
+        frame["hb_remaining_severe"].shift(1, freq="D").reindex(frame.index)
+    )
+    frame["hb_new_severe"] = frame["hb_new_severe"].fillna(
+        frame["hb_remaining_severe"] - prev_day_hb_remaining_severe
+    )
+    frame = pd.concat(
+        [frame, *(outside(frame, region) for region in OUTSIDE_REGIONS)], axis=1
+    )
+    return frame[CSV_FIELDS]
+
+
+# Return frame with labeled (CSV header) columns.
+def labeled(frame):
+    frame = frame.rename(columns=label)
+    frame.index.name = CSV_HEADER[0]
+    return frame
+
+
+# Save a labeled frame of nullable integer columns as a NumPy array holding a
+# single record, with one field of all dates, and one field of values plus
+# one of missing value masks per column. Each field is a contiguous array in
+# the file, so load_npy can wrap memory maps of them without copying.
+def save_npy(frame, path):
+    import numpy as np
+
+    n = len(frame)
+    dtype = [(CSV_HEADER[0], "M8[D]", (n,))]
+    for col in frame.columns:
+        dtype += [(col, "i8", (n,)), (col + MASK_SUFFIX, "?", (n,))]
+    array = np.zeros(1, dtype=dtype)
+    array[CSV_HEADER[0]][0] = frame.index.values.astype("M8[D]")
+    for col in frame.columns:
+        values = frame[col].array
+        array[col][0] = values.to_numpy(dtype="i8", na_value=0)
+        array[col + MASK_SUFFIX][0] = values.isna()
+    with atomic_open(path, "wb") as fp:
+        # Format 3.0 is required for non-ASCII field names.
+        np.lib.format.write_array(fp, array, version=(3, 0))
+
+
+def load_npy(path):
+    import numpy as np
+    import pandas as pd
+
+    array = np.load(path, mmap_mode="r")
+    columns = [name for name in array.dtype.names[1:] if not name.endswith(MASK_SUFFIX)]
+    return pd.DataFrame(
+        {
+            col: pd.arrays.IntegerArray(array[col][0], array[col + MASK_SUFFIX][0])
+            for col in columns
+        },
+        index=pd.DatetimeIndex(array[CSV_HEADER[0]][0], name=CSV_HEADER[0]),
+        copy=False,
+    )
+
+
+# Whether the data.npy at path was written no earlier than the data.csv at
+# csv_path, i.e. is not left over from an older version of it.
+def npy_is_current(path, csv_path):
+    try:
+        return path.stat().st_mtime_ns >= csv_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+# Add ratio columns to a frame with labeled (CSV header) columns.
+def add_ratios(df):
+    for prefix in ("", "非湖北"):
+        for ratio, numerator, denominator in RATIOS:
+            df[prefix + ratio] = df[prefix + numerator] / df[prefix + denominator]
+    return df
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# Export the site as static files, for any file server or CDN, with the Dash
+# server as the optional dynamic mode.
+#
+# index.html carries the layout of the app rendered to plain HTML; the figure
+# and the table of a tab are exported as JSON (from the tab contents built by
+# app.setup) and fetched by static/site.js when the tab is selected, like the
+# app does through callbacks. All other files are named after a hash of their
+# contents, so only index.html has to be revalidated by clients and caches.
+#
+# Date ranges only zoom the exported figures, instead of replotting them with
+# the data of the range as the app does.
+
+import argparse
+import hashlib
+import html
+import json
+import pathlib
+
+import plotly
+
+import app
+from atomicfile import atomic_write_bytes, atomic_write_text
+
+HERE = pathlib.Path(__file__).resolve().parent
+staticdir = HERE / "static"
+assetdir = HERE / "assets"
+plotlyjs = pathlib.Path(plotly.__file__).parent / "package_data" / "plotly.min.js"
+DEFAULT_OUTPUT = HERE / "deploy" / "static"
+
+# Files of the previous export, removed once no longer part of the bundle.
+MANIFEST = "manifest.json"
+
+# Attributes of HTML components rendered as is; className becomes class.
+HTML_ATTRIBUTES = ["id", "href", "target", "title"]
+
+
+# Exported files, by path relative to the output directory.
+class Bundle:
+    def __init__(self):
+        self.files = {}
+
+    # Add data as <stem>.<hash><suffix> and return its path.
+    def add_hashed(self, name, data):
+        path = pathlib.PurePosixPath(name)
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        hashed = str(path.with_name(f"{path.stem}.{digest}{path.suffix}"))
+        self.files[hashed] = data
+        return hashed
+
+    def add_json(self, name, obj):
+        data = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        return self.add_hashed(name, data.encode("utf-8"))
+
+    def write(self, outdir):
+        outdir.mkdir(parents=True, exist_ok=True)
+        try:
+            previous = json.loads((outdir / MANIFEST).read_text())["files"]
+        except (FileNotFoundError, ValueError):
+            previous = []
+        for name, data in self.files.items():
+            path = outdir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(path, data)
+        manifest = dict(files=sorted(self.files))
+        atomic_write_text(outdir / MANIFEST, json.dumps(manifest, indent=2) + "\n")
+        for name in previous:
+            if name not in self.files:
+                try:
+                    (outdir / name).unlink()
+                except FileNotFoundError:
+                    pass
+
+
+def attributes(attrs):
+    return "".join(
+        f' {name}="{html.escape(str(value))}"'
+        for name, value in attrs.items()
+        if value is not None
+    )
+
+
+# Render the layout (a tree of components) to HTML. Components other than the
+# HTML ones are rendered as the placeholders static/site.js builds on.
+def render(component):
+    if component is None:
+        return ""
+    if isinstance(component, (str, int, float)):
+        return html.escape(str(component))
+    if isinstance(component, (list, tuple)):
+        return "".join(render(child) for child in component)
+    props = component.to_plotly_json()["props"]
+    kind = component._type
+    namespace = component._namespace
+    if namespace == "dash_html_components":
+        tag = kind.lower()
+        attrs = {name: props.get(name) for name in HTML_ATTRIBUTES}
+        attrs["class"] = props.get("className")
+        children = render(props.get("children"))
+        return f"<{tag}{attributes(attrs)}>{children}</{tag}>"
+    if kind == "DangerouslySetInnerHTML":
+        return props["children"]
+    if kind == "Tabs":
+        buttons = "".join(
+            render_tab(tab.to_plotly_json()["props"], props["value"])
+            for tab in props["children"]
+        )
+        attrs = {"id": props["id"], "class": "static-tabs"}
+        return f"<div{attributes(attrs)}>{buttons}</div>"
+    if kind == "DataTable":
+        return f'<div{attributes({"id": props["id"], "class": "static-table"})}></div>'
+    if kind == "DatePickerRange":
+        inputs = "".join(
+            f'<input type="date"{attributes(attrs)}>'
+            for attrs in (
+                {
+                    "id": f"{props['id']}-start",
+                    "aria-label": props.get("start_date_placeholder_text"),
+                },
+                {
+                    "id": f"{props['id']}-end",
+                    "aria-label": props.get("end_date_placeholder_text"),
+                },
+            )
+        )
+        return f'<div{attributes({"id": props["id"]})}>{inputs}</div>'
+    raise ValueError(f"cannot render {namespace}.{kind} statically")
+
+
+def render_tab(props, selected):
+    classes = [props["className"], "static-tab"]
+    if props["value"] == selected:
+        classes.append(props["selected_className"])
+    attrs = {"class": " ".join(classes), "data-value": props["value"]}
+    return f'<button type="button"{attributes(attrs)}>{html.escape(props["label"])}</button>'
+
+
+def render_index(body, title, links, scripts, config):
+    head = "".join(
+        f"<link{attributes(dict(rel=rel, href=href))}>" for rel, href in links
+    )
+    script_tags = "".join(f'<script src="{src}"></script>' for src in scripts)
+    # Escape "</" so that the JSON cannot close the script element.
+    config_json = json.dumps(config, ensure_ascii=False).replace("</", "<\\/")
+    return (
+        "<!DOCTYPE html>\n"
+        '<html lang="zh-CN">\n<head>\n<meta charset="utf-8">\n'
+        '<meta name="viewport" content="width=device-width, initial-scale=1">\n'
+        f"<title>{html.escape(title)}</title>\n{head}\n</head>\n<body>\n"
+        f"{body}\n"
+        f'<script type="application/json" id="static-config">{config_json}</script>\n'
+        f"{script_tags}\n</body>\n</html>\n"
+    )
+
+
+def build_bundle():
+    dash_app = app.app
+    tab_contents = dash_app.data_version.tab_contents
+    bundle = Bundle()
+    figures = {}
+    for value, graph in tab_contents.contents.items():
+        props = graph["props"]
+        figures[value] = bundle.add_json(
+            f"figures/{value}.json",
+            dict(figure=props["figure"], config=props.get("config", {})),
+        )
+    tables = {
+        value: bundle.add_json(f"tables/{value}.json", table)
+        for value, table in tab_contents.tables.items()
+    }
+
+    def add_file(path):
+        return bundle.add_hashed(path.name, path.read_bytes())
+
+    links = [
+        ("icon", add_file(assetdir / "favicon.ico")),
+        ("stylesheet", add_file(assetdir / "app.css")),
+        ("stylesheet", add_file(staticdir / "site.css")),
+    ]
+    scripts = [add_file(plotlyjs), add_file(staticdir / "site.js")]
+    config = dict(
+        figures=figures,
+        tables=tables,
+        figureGroups=[group_id for group_id, _ in app.FIGURE_TAB_GROUPS],
+        tablePageSize=app.TABLE_PAGE_SIZE,
+        version=tab_contents.key,
+    )
+    index = render_index(
+        render(dash_app.layout), dash_app.title, links, scripts, config
+    )
+    bundle.files["index.html"] = index.encode("utf-8")
+    return bundle
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "outdir",
+        nargs="?",
+        type=pathlib.Path,
+        default=DEFAULT_OUTPUT,
+        help="output directory (default: deploy/static)",
+    )
+    args = parser.parse_args()
+    bundle = build_bundle()
+    bundle.write(args.outdir)
+    size = sum(len(data) for data in bundle.files.values())
+    print(
+        f"exported {len(bundle.files)} files ({size / 1024:.0f} KiB) to {args.outdir}"
+    )
+
+
+if __name__ == "__main__":
+    main()
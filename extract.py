@@ -0,0 +1,54 @@
+# Extraction of stats from report bodies.
+#
+# Each category has a regular expression with a named group of the same name
+# (or, for patterns with alternatives, a fallback group named <category>2)
+# capturing the count. Patterns are compiled once when the Extractor is
+# created rather than looked up in the re cache on every search.
+
+import re
+
+
+class Extractor:
+    def __init__(self, patterns, negative_patterns=None):
+        self.patterns = [
+            (category, self._compile(category, pattern))
+            for category, pattern in patterns.items()
+        ]
+        self.negative_patterns = {
+            category: self._compile(category, pattern)
+            for category, pattern in (negative_patterns or {}).items()
+        }
+
+    @staticmethod
+    def _compile(category, pattern):
+        regex = re.compile(pattern, re.M)
+        groups = tuple(
+            regex.groupindex[name]
+            for name in (category, f"{category}2")
+            if name in regex.groupindex
+        )
+        return regex, groups
+
+    @staticmethod
+    def _count(m, groups):
+        for group in groups:
+            value = m.group(group)
+            if value:
+                return int(value)
+        raise ValueError(f"no count captured by {m.re.pattern!r}")
+
+    # Return a dict mapping categories found in body to their counts, in the
+    # order of patterns. A negative pattern is only tried (and its count
+    # negated) if the regular pattern of the same category does not match.
+    def extract(self, body):
+        counts = {}
+        for category, (regex, groups) in self.patterns:
+            m = regex.search(body)
+            if m:
+                counts[category] = self._count(m, groups)
+            elif category in self.negative_patterns:
+                regex, groups = self.negative_patterns[category]
+                m = regex.search(body)
+                if m:
+                    counts[category] = -self._count(m, groups)
+        return counts
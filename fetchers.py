@@ -0,0 +1,231 @@
+# Backends fetching the source of a page.
+#
+# A fetcher has a fetch(url, ready_selector=None) method returning the source
+# of the page at url as bytes, once an element matching ready_selector (if
+# given) is present, and a close() method. They are shared by the fetching
+# threads, so fetch must be thread safe.
+#
+# - ChromeFetcher renders pages in Google Chrome through chrome-cli (macOS
+#   only). Needed for sites that only serve browsers, e.g. NHC.
+# - HTTPFetcher is a plain HTTP client with keep-alive connection pooling,
+#   cookies and compression. Much cheaper, but it does not run scripts, so
+#   it is only good for sites serving static pages.
+# - MirrorFetcher serves pages from a local copy of the websites.
+
+import collections
+import gzip
+import http.client
+import http.cookiejar
+import json
+import logging
+import pathlib
+import re
+import subprocess
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zlib
+
+import bs4
+
+logger = logging.getLogger(__name__)
+
+# Page readiness polling of ChromeFetcher: the interval starts at
+# READY_POLL_MIN and grows by READY_POLL_BACKOFF up to READY_POLL_MAX; a page
+# that is not ready after READY_TIMEOUT seconds is an error.
+READY_POLL_MIN = 0.1
+READY_POLL_MAX = 1
+READY_POLL_BACKOFF = 1.5
+READY_TIMEOUT = 15
+
+HTTP_TIMEOUT = 30
+HTTP_MAX_REDIRECTS = 5
+# Some sites turn away clients that do not look like a browser.
+USER_AGENT = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_3) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/80.0.3987.132 Safari/537.36"
+)
+
+
+class NotReady(RuntimeError):
+    pass
+
+
+def run(cmd, capture=False):
+    try:
+        if capture:
+            return subprocess.check_output(cmd)
+        else:
+            subprocess.check_call(cmd)
+            return
+    except subprocess.CalledProcessError as e:
+        cmd_display = " ".join(cmd)
+        logger.error(f"{cmd_display} failed: {e}")
+        raise
+
+
+class ChromeFetcher:
+    def fetch(self, url, ready_selector=None):
+        tab_id = self.open_tab(url)
+        try:
+            self.wait_until_ready(tab_id, url, ready_selector)
+            return run(("chrome-cli", "source", "-t", tab_id), capture=True)
+        finally:
+            run(("chrome-cli", "close", "-t", tab_id))
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def open_tab(url):
+        output = run(("chrome-cli", "open", url), capture=True).decode()
+        m = re.search(r"^Id: (\d+)", output, re.M)
+        if not m:
+            raise RuntimeError(f"cannot determine tab id for {url}: {output!r}")
+        return m[1]
+
+    @staticmethod
+    def wait_until_ready(tab_id, url, selector=None):
+        if selector:
+            condition = f"document.querySelector({json.dumps(selector)}) !== null"
+        else:
+            condition = 'document.readyState === "complete"'
+        script = f'({condition}) ? "ready" : ""'
+        start = time.monotonic()
+        interval = READY_POLL_MIN
+        while True:
+            output = run(("chrome-cli", "execute", script, "-t", tab_id), capture=True)
+            elapsed = time.monotonic() - start
+            if b"ready" in output:
+                return elapsed
+            if elapsed >= READY_TIMEOUT:
+                raise NotReady(f"{url} not ready after {elapsed:.1f}s")
+            time.sleep(min(interval, READY_TIMEOUT - elapsed))
+            interval = min(interval * READY_POLL_BACKOFF, READY_POLL_MAX)
+
+
+# Check that source has an element matching selector, since a static page
+# without it (e.g. a challenge page) will not get it by waiting.
+def check_ready(url, source, selector):
+    if not selector:
+        return
+    if bs4.BeautifulSoup(source, "html.parser").select_one(selector) is None:
+        raise NotReady(f"{url} has no element matching {selector!r}")
+
+
+class HTTPFetcher:
+    def __init__(self, timeout=HTTP_TIMEOUT, user_agent=USER_AGENT):
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.cookies = http.cookiejar.CookieJar()
+        # Idle connections by (scheme, host).
+        self._pool = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def fetch(self, url, ready_selector=None):
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            status, headers, body = self.request(url)
+            if status in (301, 302, 303, 307, 308) and "Location" in headers:
+                url = urllib.parse.urljoin(url, headers["Location"])
+                continue
+            if status != 200:
+                raise RuntimeError(f"{url}: HTTP {status}")
+            source = self.decode(body, headers.get("Content-Encoding"))
+            check_ready(url, source, ready_selector)
+            return source
+        raise RuntimeError(f"{url}: too many redirects")
+
+    # Return (status, headers, body) of a GET request of url, reusing an idle
+    # connection to the host if there is one. A request that fails on a reused
+    # connection (e.g. because the server has closed it in the meantime) is
+    # retried on another one, eventually a new one.
+    def request(self, url):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request = urllib.request.Request(
+            url,
+            headers={
+                "User-Agent": self.user_agent,
+                "Accept": "text/html,application/xhtml+xml,*/*;q=0.8",
+                "Accept-Encoding": "gzip, deflate",
+            },
+        )
+        with self._lock:
+            self.cookies.add_cookie_header(request)
+        headers = dict(request.header_items())
+        while True:
+            conn, reused = self.acquire(key)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            break
+        with self._lock:
+            self.cookies.extract_cookies(response, request)
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+        return response.status, response.headers, body
+
+    def acquire(self, key):
+        with self._lock:
+            if self._pool[key]:
+                return self._pool[key].pop(), True
+        scheme, host = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def release(self, key, conn):
+        with self._lock:
+            self._pool[key].append(conn)
+
+    @staticmethod
+    def decode(body, encoding):
+        if encoding == "gzip":
+            return gzip.decompress(body)
+        if encoding == "deflate":
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                # Raw deflate stream without the zlib header.
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        return body
+
+    def close(self):
+        with self._lock:
+            for conns in self._pool.values():
+                for conn in conns:
+                    conn.close()
+            self._pool.clear()
+
+
+# Serves pages from <root>/<host>/<path>.
+class MirrorFetcher:
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def path(self, url):
+        parts = urllib.parse.urlsplit(url)
+        return self.root / parts.netloc / parts.path.lstrip("/")
+
+    def fetch(self, url, ready_selector=None):
+        return self.path(url).read_bytes()
+
+    def close(self):
+        pass
+
+
+# Fetchers selectable by name (e.g. with --fetcher); MirrorFetcher is set up
+# with --mirror instead.
+FETCHERS = {"chrome": ChromeFetcher, "http": HTTPFetcher}
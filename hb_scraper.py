@@ -1,19 +1,40 @@
 #!/usr/bin/env python3
 
+import argparse
 import datetime
 import re
 import sys
 
 import bs4
 
-from scraper import logger, network_retry, fetch_dom, DataEntry
+import metrics
+from extract import Extractor
+from scraper import (
+    logger,
+    network_retry,
+    fetch_dom,
+    fetch_many,
+    close_fetchers,
+    add_fetch_arguments,
+    configure_fetching,
+    init_database,
+    stat_rows,
+    save_stats,
+    stored_stats,
+    DataEntry,
+)
+
+
+def extract_article(dom):
+    s = bs4.BeautifulSoup(dom, "html.parser")
+    return s.select_one("#article-box").get_text().strip()
 
 
 @network_retry
 def get_article(url):
-    with fetch_dom(url) as dom:
-        s = bs4.BeautifulSoup(dom, "html.parser")
-        body = s.select_one("#article-box").get_text().strip()
+    with fetch_dom(url, ready_selector="#article-box") as dom:
+        with metrics.span("dom_parse", page="article"):
+            body = extract_article(dom)
     print(body)
     return body
 
@@ -38,6 +59,9 @@ introduced = {
 }
 
 
+extractor = Extractor(patterns)
+
+
 def parse_article(body):
     m = date_pattern.match(body)
     month = int(m["month"])
@@ -46,17 +70,16 @@ def parse_article(body):
     date_str = f"{month:02}-{day:02}"
     print(date_str)
     data = dict(date=date)
+    with metrics.span("extract", source="hb"):
+        counts = extractor.extract(body)
     for category, pattern in patterns.items():
-        if m := re.search(pattern, body, re.M):
-            if m[category]:
-                count = int(m[category])
-            else:
-                count = int(m[f"{category}2"])
-            data[category] = count
+        if category in counts:
+            count = data[category] = counts[category]
             print(f"{count}\t{category}")
             continue
         if category in introduced and date_str < introduced[category]:
             continue
+        metrics.inc("match_misses_total", source="hb", category=category)
         logger.critical(f"{date}: no match for {category}: {pattern!r}")
     if "hb_remaining_critical" in data:
         data["hb_remaining_severe"] += data["hb_remaining_critical"]
@@ -74,7 +97,15 @@ def parse_article(body):
 
 
 def main():
-    for url in (
+    parser = argparse.ArgumentParser()
+    add_fetch_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    configure_fetching(args)
+    metrics.configure(args.metrics_jsonl, args.metrics_textfile)
+    init_database()
+
+    urls = (
         "http://wjw.hubei.gov.cn/fbjd/dtyw/202002/t20200212_2024650.shtml",  # 02-11
         "http://wjw.hubei.gov.cn/fbjd/tzgg/202002/t20200211_2023521.shtml",  # 02-10
         "http://wjw.hubei.gov.cn/fbjd/tzgg/202002/t20200210_2022515.shtml",  # 02-09
@@ -95,23 +126,30 @@ def main():
         "http://wjw.hubei.gov.cn/fbjd/tzgg/202001/t20200129_2016112.shtml",  # 01-25
         "http://wjw.hubei.gov.cn/fbjd/tzgg/202001/t20200125_2014856.shtml",  # 01-24
         "http://wjw.hubei.gov.cn/fbjd/dtyw/202001/t20200124_2014626.shtml",  # 01-23
-    ):
-        body = get_article(url)
+    )
+    # Stats are saved in one transaction after all articles have been checked.
+    rows = []
+    for body in fetch_many(get_article, urls, jobs=args.jobs):
         data = parse_article(body)
         date = data["date"]
         print(data)
-        entry = DataEntry.get(date=date)
+        # Only supplements days already scraped from NHC.
+        DataEntry.get(date=date)
+        existing = stored_stats([date])[date]
         for key in patterns:
             if key == "hb_remaining_critical":
                 continue
             val = data.get(key)
-            existing_val = getattr(entry, key)
+            existing_val = existing.get(key)
             if existing_val is not None and val is not None and existing_val != val:
                 logger.critical(
                     f"{date} {key} discrepancy: NHC value {existing_val}, Hubei HC value {val}"
                 )
                 sys.exit(1)
-        DataEntry.update(**data).where(DataEntry.date == date).execute()
+        rows.extend(stat_rows(date, data))
+    close_fetchers()
+    with metrics.span("db_write"):
+        save_stats(rows)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,240 @@
+# Timings and counters of scraper runs and of the web app.
+#
+# Stages are timed with span(name, **labels), which records the duration in
+# the histogram <name>_seconds; inc, observe and set_gauge update counters,
+# other histograms and gauges. Everything is labeled like Prometheus metrics.
+#
+# Metrics are off unless enabled, and then cost next to nothing: span returns
+# a shared no-op context manager and the others return right away. The
+# scrapers enable them with configure(), which writes them
+#
+# - as JSON lines: one line per span as it ends, plus the final value of each
+#   counter and histogram when the run ends;
+# - as a Prometheus text file (e.g. for the node exporter's textfile
+#   collector), written atomically when the run ends.
+#
+# The web app keeps them in memory and serves render() (see app.py).
+
+import atexit
+import bisect
+import datetime
+import json
+import threading
+import time
+
+from atomicfile import atomic_write_text
+
+PREFIX = "ncov_"
+# Upper bounds of histogram buckets, in seconds for span durations.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+enabled = False
+jsonl_path = None
+textfile_path = None
+
+_lock = threading.Lock()
+_jsonl = None
+# Values keyed by (name, sorted label items).
+_counters = {}
+# [bucket counts, sum, count] keyed by (name, sorted label items).
+_histograms = {}
+_gauges = {}
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+class _Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        if exc_type is not None:
+            self.labels["error"] = exc_type.__name__
+        observe(f"{self.name}_seconds", seconds, **self.labels)
+        _write_line(
+            dict(
+                type="span",
+                name=self.name,
+                labels=self.labels,
+                start=_isoformat(self.start),
+                seconds=round(seconds, 6),
+            )
+        )
+        return False
+
+
+def span(name, **labels):
+    if not enabled:
+        return _no_span
+    return _Span(name, labels)
+
+
+def inc(name, value=1, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    i = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0, 0])
+        if i < len(BUCKETS):
+            histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def set_gauge(name, value, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _gauges[key] = value
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds")
+
+
+def _write_line(record):
+    if _jsonl is None:
+        return
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _lock:
+        _jsonl.write(line)
+        _jsonl.flush()
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("metrics")
+    group.add_argument(
+        "--metrics-jsonl",
+        metavar="FILE",
+        help="append timings of each stage and final counters to FILE as JSON lines",
+    )
+    group.add_argument(
+        "--metrics-textfile",
+        metavar="FILE",
+        help="write the metrics of the run to FILE in the Prometheus text format",
+    )
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+# Enable metrics if any destination is given (see add_arguments); the final
+# values are written when the process exits.
+def configure(jsonl=None, textfile=None):
+    global jsonl_path, textfile_path, _jsonl
+    if not jsonl and not textfile:
+        return
+    jsonl_path, textfile_path = jsonl, textfile
+    if jsonl:
+        _jsonl = open(jsonl, "a", encoding="utf-8")
+    enable()
+    atexit.register(flush)
+
+
+# Return copies of the counters, histograms and gauges.
+def snapshot():
+    with _lock:
+        return (
+            dict(_counters),
+            {
+                key: (list(buckets), total, count)
+                for key, (buckets, total, count) in _histograms.items()
+            },
+            dict(_gauges),
+        )
+
+
+# Write the counters and histograms to the configured destinations.
+def flush():
+    counters, histograms, _ = snapshot()
+    now = _isoformat(time.time())
+    for (name, labels), value in sorted(counters.items()):
+        _write_line(
+            dict(type="counter", name=name, labels=dict(labels), value=value, time=now)
+        )
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        _write_line(
+            dict(
+                type="histogram",
+                name=name,
+                labels=dict(labels),
+                buckets=dict(zip(map(str, BUCKETS), buckets)),
+                sum=round(total, 6),
+                count=count,
+                time=now,
+            )
+        )
+    if textfile_path:
+        # Written through a temporary file, so that a collector never reads a
+        # partial file.
+        atomic_write_text(textfile_path, render(), encoding="utf-8")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+# Return all metrics in the Prometheus text format.
+def render():
+    counters, histograms, gauges = snapshot()
+    lines = []
+    typed = set()
+
+    def add_type(metric, kind):
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} {kind}")
+            typed.add(metric)
+
+    for (name, labels), value in sorted(counters.items()):
+        add_type(PREFIX + name, "counter")
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(gauges.items()):
+        add_type(PREFIX + name, "gauge")
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        metric = PREFIX + name
+        add_type(metric, "histogram")
+        cumulative = 0
+        for bound, n in zip(BUCKETS, buckets):
+            cumulative += n
+            bucket_labels = labels + (("le", str(bound)),)
+            lines.append(f"{metric}_bucket{_format_labels(bucket_labels)} {cumulative}")
+        inf_labels = labels + (("le", "+Inf"),)
+        lines.append(f"{metric}_bucket{_format_labels(inf_labels)} {count}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
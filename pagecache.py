@@ -0,0 +1,120 @@
+# Content-addressed on-disk cache of raw page sources.
+#
+# Sources are stored zlib-compressed under <root>/objects/<digest[:2]>/<digest>,
+# where digest is the SHA-256 of the uncompressed source, so identical pages
+# fetched at different times share storage. A small SQLite index maps
+# (url, fetch time) to digests and tracks object sizes and access times for
+# LRU eviction once the total compressed size exceeds max_size.
+
+import contextlib
+import datetime
+import hashlib
+import pathlib
+import threading
+import zlib
+
+import peewee
+
+from atomicfile import atomic_write_bytes
+
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+database = peewee.SqliteDatabase(None)
+
+
+class CachedObject(peewee.Model):
+    digest = peewee.CharField(primary_key=True)
+    size = peewee.IntegerField()
+    last_access = peewee.DateTimeField(index=True)
+
+    class Meta:
+        database = database
+
+
+class CachedFetch(peewee.Model):
+    url = peewee.TextField()
+    fetched_at = peewee.DateTimeField()
+    digest = peewee.CharField(index=True)
+
+    class Meta:
+        database = database
+        indexes = ((("url", "fetched_at"), True),)
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+class PageCache:
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        self.root = pathlib.Path(root)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.root.joinpath("objects").mkdir(parents=True, exist_ok=True)
+        database.init(self.root.joinpath("index.db").as_posix())
+        database.create_tables([CachedObject, CachedFetch], safe=True)
+
+    def object_path(self, digest):
+        return self.root / "objects" / digest[:2] / digest
+
+    def put(self, url, source, fetched_at=None):
+        fetched_at = fetched_at or datetime.datetime.utcnow()
+        digest = hashlib.sha256(source).hexdigest()
+        with self._lock, database.atomic():
+            path = self.object_path(digest)
+            if not path.exists():
+                path.parent.mkdir(exist_ok=True)
+                data = zlib.compress(source, 9)
+                atomic_write_bytes(path, data)
+                CachedObject.replace(
+                    digest=digest, size=len(data), last_access=fetched_at
+                ).execute()
+            else:
+                CachedObject.update(last_access=fetched_at).where(
+                    CachedObject.digest == digest
+                ).execute()
+            CachedFetch.replace(url=url, fetched_at=fetched_at, digest=digest).execute()
+            self._evict()
+        return digest
+
+    # Return the most recently fetched source of url (or the most recent one
+    # fetched no later than at); raise CacheMiss if there is none.
+    def get(self, url, at=None):
+        query = CachedFetch.select().where(CachedFetch.url == url)
+        if at is not None:
+            query = query.where(CachedFetch.fetched_at <= at)
+        fetch = query.order_by(CachedFetch.fetched_at.desc()).first()
+        if fetch is None:
+            raise CacheMiss(url)
+        try:
+            data = self.object_path(fetch.digest).read_bytes()
+        except FileNotFoundError:
+            raise CacheMiss(url)
+        with self._lock:
+            CachedObject.update(last_access=datetime.datetime.utcnow()).where(
+                CachedObject.digest == fetch.digest
+            ).execute()
+        return zlib.decompress(data)
+
+    def __contains__(self, url):
+        return CachedFetch.select().where(CachedFetch.url == url).exists()
+
+    def total_size(self):
+        total = peewee.fn.COALESCE(peewee.fn.SUM(CachedObject.size), 0)
+        return CachedObject.select(total).scalar()
+
+    # Drop least recently accessed objects (and fetches pointing to them)
+    # until the total compressed size is within max_size.
+    def _evict(self):
+        excess = self.total_size() - self.max_size
+        if excess <= 0:
+            return
+        for obj in CachedObject.select().order_by(CachedObject.last_access):
+            CachedFetch.delete().where(CachedFetch.digest == obj.digest).execute()
+            obj.delete_instance()
+            with contextlib.suppress(FileNotFoundError):
+                self.object_path(obj.digest).unlink()
+            excess -= obj.size
+            if excess <= 0:
+                break
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Re-run parse_article over article bodies already stored in data.db, e.g.
+# after fixing a pattern, and update only the fields whose values changed.
+#
+# Fields that parse_article does not return for an article are left alone,
+# since they may have been filled in from other sources (see hb_scraper.py).
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import os
+import time
+
+from scraper import (
+    logger,
+    init_database,
+    load_bodies,
+    parse_article,
+    stat_rows,
+    save_stats,
+    stored_stats,
+    DataEntry,
+)
+
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def reparse_article(article):
+    title, body = article
+    # parse_article prints everything it finds; that's just noise here.
+    with contextlib.redirect_stdout(io.StringIO()):
+        return parse_article(title, body)
+
+
+def iter_batches(batch_size):
+    last_id = 0
+    while True:
+        batch = list(
+            DataEntry.select()
+            .where(DataEntry.id > last_id)
+            .order_by(DataEntry.id)
+            .limit(batch_size)
+        )
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
+# Return a list of (date, changed) for entries whose stored stats differ from
+# the reparsed ones, where changed maps the changed fields to the new values.
+def diff_batch(entries, results):
+    stored = stored_stats([entry.date for entry in entries])
+    changes = []
+    for entry, data in zip(entries, results):
+        if data["date"] != entry.date:
+            logger.warning(
+                f"{entry.article_url}: reparsed date {data['date']} "
+                f"differs from stored date {entry.date}, skipping"
+            )
+            continue
+        stats = stored[entry.date]
+        changed = {}
+        for field, value in data.items():
+            if field == "date" or stats.get(field) == value:
+                continue
+            logger.info(f"{entry.date} {field}: {stats.get(field)} => {value}")
+            changed[field] = value
+        if changed:
+            changes.append((entry.date, changed))
+    return changes
+
+
+def apply_changes(changes):
+    save_stats([row for date, changed in changes for row in stat_rows(date, changed)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="number of rows loaded and updated at a time "
+        f"(default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of parser processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="report changes without writing them to the database",
+    )
+    args = parser.parse_args()
+    init_database()
+
+    start = time.monotonic()
+    total_rows = 0
+    total_changed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for batch in iter_batches(args.batch_size):
+            bodies = load_bodies(entry.article_body_digest for entry in batch)
+            results = executor.map(
+                reparse_article,
+                [
+                    (entry.article_title, bodies[entry.article_body_digest])
+                    for entry in batch
+                ],
+                chunksize=max(1, len(batch) // (args.jobs * 4)),
+            )
+            changes = diff_batch(batch, results)
+            if changes and not args.dry_run:
+                apply_changes(changes)
+            total_rows += len(batch)
+            total_changed += len(changes)
+    elapsed = time.monotonic() - start
+    logger.info(
+        f"reparsed {total_rows} rows in {elapsed:.2f}s "
+        f"({total_rows / elapsed if elapsed else 0:.0f} rows/s), "
+        f"{total_changed} rows {'would be ' if args.dry_run else ''}updated"
+    )
+
+
+if __name__ == "__main__":
+    main()
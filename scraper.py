@@ -3,187 +3,569 @@
 # Legacy data scraper for Health Commission of Hubei Province website.
 # http://wjw.hubei.gov.cn/fbjd/tzgg/index.shtml
 
+import argparse
+import concurrent.futures
 import contextlib
 import csv
 import datetime
+import hashlib
+import io
+import json
 import logging
 import pathlib
 import re
-import subprocess
+import threading
 import time
 import urllib.parse
+import zlib
 
 import bs4
 import peewee
+import playhouse.migrate
 import tenacity
 
+import derived
+import metrics
+from atomicfile import atomic_write_text
+from extract import Extractor
+from fetchers import FETCHERS, MirrorFetcher
+from pagecache import DEFAULT_MAX_SIZE, CacheMiss, PageCache
 
 logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+
+def count_retry(retry_state):
+    metrics.inc("retries_total", function=retry_state.fn.__name__)
+
+
 network_retry = tenacity.retry(
-    wait=tenacity.wait_fixed(2), stop=tenacity.stop_after_attempt(3)
+    wait=tenacity.wait_fixed(2),
+    stop=tenacity.stop_after_attempt(3),
+    retry=tenacity.retry_if_exception(lambda e: not isinstance(e, CacheMiss)),
+    before_sleep=count_retry,
 )
 
 HERE = pathlib.Path(__file__).resolve().parent
-database = peewee.SqliteDatabase(HERE.joinpath("data.db").as_posix())
+dbfile = HERE / "data.db"
 datafile = HERE / "data.csv"
 datamod = HERE / "data.py"
+manifestfile = HERE / "data.csv.manifest.json"
+npyfile = HERE / "data.npy"
+cachedir = HERE / "cache"
+
+# Number of pages fetched concurrently (with Chrome, each in its own tab).
+DEFAULT_JOBS = 4
+# Minimum interval in seconds between two requests to the same host.
+HOST_INTERVAL = 1
+
+# Fetcher (see fetchers.FETCHERS) used for pages of each host, and for pages
+# of other hosts. The Hubei Health Commission serves static pages that do not
+# need a browser.
+SITE_FETCHERS = {"wjw.hubei.gov.cn": "http"}
+DEFAULT_FETCHER = "chrome"
+
+site_fetchers = dict(SITE_FETCHERS)
+default_fetcher = DEFAULT_FETCHER
+
+# When set to a directory, pages are served from <mirror_root>/<host>/<path>
+# instead of being fetched. Useful for testing against a local copy of the
+# websites.
+mirror_root = None
+
+# Raw sources of all fetched pages are saved to page_cache (if not None). In
+# offline mode pages are served from the cache only.
+page_cache = None
+offline = False
+
+
+# data.db is opened by init_database. In WAL mode readers (e.g. an export)
+# are not blocked while a scrape is writing; synchronous=NORMAL is safe with
+# WAL and only syncs at checkpoints.
+database = peewee.SqliteDatabase(None)
+PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -64 * 1024,  # KiB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+}
+# Rows per INSERT statement, keeping the number of bound variables below
+# SQLite's (default) limit of 999.
+INSERT_BATCH_SIZE = 200
+
+
+# Article bodies are kept out of DataEntry, zlib compressed and stored once per
+# distinct text, keyed by the SHA-256 of the text.
+class ArticleBody(peewee.Model):
+    digest = peewee.CharField(primary_key=True)
+    data = peewee.BlobField()
+
+    class Meta:
+        database = database
 
 
 class DataEntry(peewee.Model):
     date = peewee.DateField(unique=True)
 
-    total_confirmed = peewee.IntegerField(null=True)
-    remaining_confirmed = peewee.IntegerField(null=True)
-    remaining_severe = peewee.IntegerField(null=True)
-    remaining_suspected = peewee.IntegerField(null=True)
-    cured = peewee.IntegerField(null=True)
-    death = peewee.IntegerField(null=True)
-    new_confirmed = peewee.IntegerField(null=True)
-    new_severe = peewee.IntegerField(null=True)
-    new_suspected = peewee.IntegerField(null=True)
-    new_cured = peewee.IntegerField(null=True)
-    new_death = peewee.IntegerField(null=True)
-    total_tracked = peewee.IntegerField(null=True)
-    new_lifted = peewee.IntegerField(null=True)
-    remaining_quarantined = peewee.IntegerField(null=True)
-    hb_total_confirmed = peewee.IntegerField(null=True)
-    hb_remaining_confirmed = peewee.IntegerField(null=True)
-    hb_remaining_severe = peewee.IntegerField(null=True)
-    hb_remaining_suspected = peewee.IntegerField(null=True)
-    hb_cured = peewee.IntegerField(null=True)
-    hb_death = peewee.IntegerField(null=True)
-    hb_new_confirmed = peewee.IntegerField(null=True)
-    hb_new_severe = peewee.IntegerField(null=True)
-    hb_new_suspected = peewee.IntegerField(null=True)
-    hb_new_cured = peewee.IntegerField(null=True)
-    hb_new_death = peewee.IntegerField(null=True)
-
     article_url = peewee.TextField(unique=True)
     article_title = peewee.TextField()
-    article_body = peewee.TextField()
+    article_body_digest = peewee.CharField()
 
     class Meta:
         database = database
 
-    # Calculate remaining confirmed when official report does not
-    # include this stat.
-    @property
-    def remaining_confirmed_calc(self):
-        if self.remaining_confirmed is not None:
-            return self.remaining_confirmed
-        if self.cured is not None and self.death is not None:
-            return self.total_confirmed - self.cured - self.death
-        return None
 
-    # Calculate new severe cases in Hubei when official report does not
-    # include this stat.
-    @property
-    def hb_new_severe_calc(self):
-        if self.hb_new_severe is not None:
-            return self.hb_new_severe
-        if self.hb_remaining_severe is not None:
-            prev_day = self.date - datetime.timedelta(days=1)
-            try:
-                prev_day_entry = DataEntry.get(date=prev_day)
-            except peewee.DoesNotExist:
-                return None
-            if prev_day_entry.hb_remaining_severe is not None:
-                return self.hb_remaining_severe - prev_day_entry.hb_remaining_severe
-        return None
+# One stat of one region on one day, with regions and metrics as listed in
+# derived.REGIONS and derived.METRICS. Missing stats have no rows.
+class Stat(peewee.Model):
+    date = peewee.DateField()
+    region = peewee.CharField()
+    metric = peewee.CharField()
+    value = peewee.IntegerField()
 
-    def __getattr__(self, name):
-        if not name.startswith("not_hb_"):
-            raise AttributeError
-        national_attr = name[7:]
-        national_val = getattr(self, national_attr)
-        if national_val is None:
-            try:
-                national_val = getattr(self, f"{national_attr}_calc")
-            except AttributeError:
-                pass
-        hb_attr = name[4:]
-        hb_val = getattr(self, hb_attr)
-        if hb_val is None:
-            try:
-                hb_val = getattr(self, f"{hb_attr}_calc")
-            except AttributeError:
-                pass
-        if national_val is not None and hb_val is not None:
-            return national_val - hb_val
-        else:
-            return None
+    class Meta:
+        database = database
+        primary_key = peewee.CompositeKey("date", "region", "metric")
+        # For series of some regions or metrics over all dates.
+        indexes = ((("region", "metric", "date"), False),)
 
 
-database.create_tables([DataEntry], safe=True)
+# Crawl state of an index page as of the last run: a fingerprint of the
+# articles listed on it and the newest (first) of them. The newest article of
+# the first page is where the next incremental crawl stops.
+class IndexPage(peewee.Model):
+    url = peewee.TextField(primary_key=True)
+    fingerprint = peewee.CharField()
+    newest_url = peewee.TextField()
+    crawled_at = peewee.DateTimeField()
 
+    class Meta:
+        database = database
 
-def run(cmd, capture=False):
-    try:
-        if capture:
-            return subprocess.check_output(cmd)
-        else:
-            subprocess.check_call(cmd)
-            return
-    except subprocess.CalledProcessError as e:
-        cmd_display = " ".join(cmd)
-        logger.error(f"{cmd_display} failed: {e}")
-        raise
 
+# Move stats stored as columns of DataEntry (by earlier versions) into Stat.
+def migrate_stat_columns():
+    columns = [
+        column.name
+        for column in database.get_columns(DataEntry._meta.table_name)
+        if column.name in derived.RAW_FIELDS
+    ]
+    if not columns:
+        return
+    logger.info(f"moving {len(columns)} stat columns of data entries to stats")
+    migrator = playhouse.migrate.SqliteMigrator(database)
+    with database.atomic():
+        for column in columns:
+            database.execute_sql(
+                f"INSERT OR REPLACE INTO {Stat._meta.table_name} "
+                f"(date, region, metric, value) "
+                f'SELECT date, ?, ?, "{column}" FROM {DataEntry._meta.table_name} '
+                f'WHERE "{column}" IS NOT NULL',
+                derived.split_field(column),
+            )
+        playhouse.migrate.migrate(
+            *(
+                migrator.drop_column(DataEntry._meta.table_name, column)
+                for column in columns
+            )
+        )
+
+
+# Move article bodies stored in DataEntry (by earlier versions) into
+# ArticleBody.
+def migrate_article_bodies():
+    table = DataEntry._meta.table_name
+    columns = [column.name for column in database.get_columns(table)]
+    if "article_body" not in columns:
+        return
+    logger.info("moving article bodies of data entries to article bodies")
+    migrator = playhouse.migrate.SqliteMigrator(database)
+    with database.atomic():
+        playhouse.migrate.migrate(
+            migrator.add_column(
+                table, "article_body_digest", peewee.CharField(null=True)
+            )
+        )
+        rows = database.execute_sql(f"SELECT id, article_body FROM {table}").fetchall()
+        digests = save_bodies([body for _, body in rows])
+        for (id, _), digest in zip(rows, digests):
+            DataEntry.update(article_body_digest=digest).where(
+                DataEntry.id == id
+            ).execute()
+        playhouse.migrate.migrate(
+            migrator.drop_column(table, "article_body"),
+            migrator.add_not_null(table, "article_body_digest"),
+        )
+
+
+def init_database(path=dbfile, pragmas=PRAGMAS):
+    database.init(pathlib.Path(path).as_posix(), pragmas=pragmas)
+    database.create_tables([ArticleBody, DataEntry, Stat, IndexPage], safe=True)
+    migrate_stat_columns()
+    migrate_article_bodies()
+
+
+def body_digest(body):
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+# Store article bodies that are not stored yet and return their digests.
+def save_bodies(bodies):
+    digests = [body_digest(body) for body in bodies]
+    new = dict(zip(digests, bodies))
+    for batch in peewee.chunked(list(new), INSERT_BATCH_SIZE):
+        query = ArticleBody.select(ArticleBody.digest).where(
+            ArticleBody.digest.in_(batch)
+        )
+        for (digest,) in query.tuples():
+            del new[digest]
+    with database.atomic():
+        for batch in peewee.chunked(new.items(), INSERT_BATCH_SIZE):
+            ArticleBody.insert_many(
+                [
+                    (digest, zlib.compress(body.encode("utf-8"), 9))
+                    for digest, body in batch
+                ],
+                fields=[ArticleBody.digest, ArticleBody.data],
+            ).on_conflict_ignore().execute()
+    return digests
+
+
+# Return {digest: body} of the stored article bodies with digests.
+def load_bodies(digests):
+    bodies = {}
+    for batch in peewee.chunked(list(set(digests)), INSERT_BATCH_SIZE):
+        query = ArticleBody.select().where(ArticleBody.digest.in_(batch))
+        for digest, data in query.tuples():
+            bodies[digest] = zlib.decompress(data).decode("utf-8")
+    return bodies
+
+
+# Insert DataEntry rows for articles, dicts of date, article_url,
+# article_title and article_body.
+def save_articles(articles):
+    digests = save_bodies([article["article_body"] for article in articles])
+    entries = [
+        dict(
+            date=article["date"],
+            article_url=article["article_url"],
+            article_title=article["article_title"],
+            article_body_digest=digest,
+        )
+        for article, digest in zip(articles, digests)
+    ]
+    with database.atomic():
+        for batch in peewee.chunked(entries, INSERT_BATCH_SIZE):
+            DataEntry.insert_many(batch).execute()
+
+
+# Return Stat rows of the stats in data (a dict mapping fields, e.g.
+# hb_total_confirmed, to values) of date. Keys other than raw fields and
+# missing values are ignored.
+def stat_rows(date, data):
+    return [
+        (date, *derived.split_field(name), value)
+        for name, value in data.items()
+        if name in derived.RAW_FIELDS and value is not None
+    ]
+
+
+# Insert or replace Stat rows (see stat_rows). This goes through executemany
+# since building a multi-row INSERT in peewee costs far more than executing it.
+def save_stats(rows):
+    sql = (
+        f'INSERT OR REPLACE INTO "{Stat._meta.table_name}" '
+        '("date", "region", "metric", "value") VALUES (?, ?, ?, ?)'
+    )
+    with database.atomic():
+        database.cursor().executemany(
+            sql,
+            [
+                (date.isoformat(), region, metric, value)
+                for date, region, metric, value in rows
+            ],
+        )
+
+
+# Return {date: {field: value}} of the stored stats of dates.
+def stored_stats(dates):
+    stats = {date: {} for date in dates}
+    query = Stat.select(Stat.date, Stat.region, Stat.metric, Stat.value).where(
+        Stat.date.in_(list(stats))
+    )
+    for date, region, metric, value in query.tuples():
+        stats[date][derived.field(region, metric)] = value
+    return stats
+
+
+# Return a frame of the stored stats (see derived.pivot), optionally limited
+# to some regions, metrics and dates (inclusive).
+def load_stats(regions=None, metric_names=None, start=None, end=None):
+    query = Stat.select(Stat.date, Stat.region, Stat.metric, Stat.value)
+    if regions is not None:
+        query = query.where(Stat.region.in_(regions))
+    if metric_names is not None:
+        query = query.where(Stat.metric.in_(metric_names))
+    if start is not None:
+        query = query.where(Stat.date >= start)
+    if end is not None:
+        query = query.where(Stat.date <= end)
+    fields = [
+        name
+        for name in derived.RAW_FIELDS
+        if (regions is None or derived.split_field(name)[0] in regions)
+        and (metric_names is None or derived.split_field(name)[1] in metric_names)
+    ]
+    return derived.pivot(query.tuples(), fields)
+
+
+class HostRateLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    # Block until the next request slot for the host of url is available.
+    def wait(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+rate_limiter = HostRateLimiter(HOST_INTERVAL)
+
+
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+
+def get_fetcher(url):
+    if mirror_root is not None:
+        name = "mirror"
+    else:
+        host = urllib.parse.urlsplit(url).hostname
+        name = site_fetchers.get(host, default_fetcher)
+    with _fetchers_lock:
+        if name not in _fetchers:
+            if name == "mirror":
+                _fetchers[name] = MirrorFetcher(mirror_root)
+            else:
+                _fetchers[name] = FETCHERS[name]()
+        return _fetchers[name]
 
-@contextlib.contextmanager
-def fetch_dom(url):
-    logger.info(f"fetching {url}")
-    run(("chrome-cli", "open", url))
-    time.sleep(3)
-    try:
-        yield run(("chrome-cli", "source"), capture=True)
-    finally:
-        run(("chrome-cli", "close"))
 
+def close_fetchers():
+    with _fetchers_lock:
+        for fetcher in _fetchers.values():
+            fetcher.close()
+        _fetchers.clear()
 
-def get_article_list(seen_urls):
-    @network_retry
-    def get_single_page(index_url):
+
+# Seconds each fetched page took to be fetched (and become ready), keyed by
+# URL.
+page_load_times = {}
+
+
+def fetch_source(url, ready_selector=None):
+    host = urllib.parse.urlsplit(url).hostname
+    with metrics.span("rate_limit_wait", host=host):
+        rate_limiter.wait(url)
+    logger.info(f"fetching {url}")
+    start = time.monotonic()
+    with metrics.span("fetch", host=host):
+        source = get_fetcher(url).fetch(url, ready_selector)
+    elapsed = page_load_times[url] = time.monotonic() - start
+    metrics.inc("pages_fetched_total", host=host)
+    metrics.inc("bytes_fetched_total", len(source), host=host)
+    logger.info(f"{url} ready in {elapsed:.2f}s")
+    return source
+
+
+# Yield the source of url once the page is ready, i.e. once an element
+# matching ready_selector is present (or once the document has loaded if no
+# selector is given).
+@contextlib.contextmanager
+def fetch_dom(url, ready_selector=None):
+    if offline:
+        source = page_cache.get(url)
+        metrics.inc("pages_from_cache_total")
+        yield source
+        return
+    source = fetch_source(url, ready_selector)
+    if page_cache is not None:
+        page_cache.put(url, source)
+    yield source
+
+
+# Apply func to each of urls on a pool of jobs workers. Results are returned
+# in the order of urls, regardless of the order in which fetches complete.
+def fetch_many(func, urls, jobs=DEFAULT_JOBS):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, urls))
+
+
+def index_page_url(page):
+    if page == 1:
+        return "http://www.nhc.gov.cn/yjb/pqt/new_list.shtml"
+    return f"http://www.nhc.gov.cn/yjb/pqt/new_list_{page}.shtml"
+
+
+def index_fingerprint(articles):
+    h = hashlib.sha256()
+    for url, title in articles:
+        h.update(f"{url}\t{title}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+# Return the subset of urls already stored.
+def stored_urls(urls):
+    stored = set()
+    for batch in peewee.chunked(list(urls), INSERT_BATCH_SIZE):
+        query = DataEntry.select(DataEntry.article_url).where(
+            DataEntry.article_url.in_(batch)
+        )
+        stored.update(url for url, in query.tuples())
+    return stored
+
+
+# Return (articles, index_pages), where articles are the (url, title) of
+# articles not stored yet, oldest first, and index_pages the IndexPage rows
+# (as dicts) of the index pages crawled, to be saved once the articles are.
+#
+# An incremental crawl stops at the newest article seen by the last crawl
+# (or at a page ending with an article already stored, if there is no crawl
+# state), so a daily run usually fetches only the first page, and nothing
+# else if that page has not changed. With full, the whole index is walked.
+def get_article_list(jobs=DEFAULT_JOBS, full=False):
+    # Return the (url, title) of the daily reports on an index page, or None
+    # if it has no list of articles at all (i.e. it is past the end).
+    def fetch_single_page(index_url):
         results = []
-        with fetch_dom(index_url) as dom:
-            soup = bs4.BeautifulSoup(dom, "html.parser")
-            for a in soup.select_one(".list").select("li > a"):
-                url = urllib.parse.urljoin(index_url, a["href"])
-                title = a["title"]
-                if title_pattern.match(title):
-                    results.append((url, title))
+        with fetch_dom(index_url, ready_selector=".list") as dom:
+            with metrics.span("dom_parse", page="index"):
+                soup = bs4.BeautifulSoup(dom, "html.parser")
+                article_list = soup.select_one(".list")
+                if article_list is None:
+                    return None
+                for a in article_list.select("li > a"):
+                    url = urllib.parse.urljoin(index_url, a["href"])
+                    title = a["title"]
+                    if title_pattern.match(title):
+                        results.append((url, title))
         return results
 
+    get_single_page = network_retry(fetch_single_page)
+
+    # Return the articles on page p, fetched by future. Pages after the first
+    # of a window are fetched speculatively without retries, so that pages
+    # past the end of the index fail fast; when such a page turns out to be
+    # needed and failed, it is fetched again, with retries.
+    def page_result(p, future, speculative):
+        try:
+            return future.result()
+        except Exception:
+            if not speculative:
+                raise
+            return get_single_page(index_page_url(p))
+
+    previous = {page.url: page for page in IndexPage.select()}
+    first_page = previous.get(index_page_url(1))
+    frontier = first_page.newest_url if first_page and not full else None
+    now = datetime.datetime.utcnow()
+
+    # The first page is fetched on its own since that's usually all we need;
+    # after that index pages are fetched jobs at a time. Pages past the stop
+    # condition may be fetched speculatively, but their results (and errors)
+    # are discarded, and they are not waited for.
     articles = []
+    index_pages = []
     page = 1
-    index_url = "http://www.nhc.gov.cn/yjb/pqt/new_list.shtml"
+    window = 1
     while True:
-        articles.extend(get_single_page(index_url))
-        last_article_url, last_article_title = articles[-1]
-        if (
-            last_article_title == "1月21日新型冠状病毒感染的肺炎疫情情况"
-            or last_article_url in seen_urls
-        ):
-            break
-        page += 1
-        index_url = f"http://www.nhc.gov.cn/yjb/pqt/new_list_{page}.shtml"
-    return list(reversed(articles))
+        pages = range(page, page + window)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=window)
+        futures = [executor.submit(get_single_page, index_page_url(page))] + [
+            executor.submit(fetch_single_page, index_page_url(p)) for p in pages[1:]
+        ]
+        try:
+            for p, future in zip(pages, futures):
+                index_url = index_page_url(p)
+                page_articles = page_result(p, future, p != page)
+                # A page without any daily report does not end the crawl, only
+                # a page without a list does.
+                stop = page_articles is None
+                if page_articles:
+                    fingerprint = index_fingerprint(page_articles)
+                    unchanged = (
+                        index_url in previous
+                        and previous[index_url].fingerprint == fingerprint
+                    )
+                    if p == 1 and unchanged and not full:
+                        logger.info("index unchanged since the last crawl")
+                        return [], []
+                    index_pages.append(
+                        dict(
+                            url=index_url,
+                            fingerprint=fingerprint,
+                            newest_url=page_articles[0][0],
+                            crawled_at=now,
+                        )
+                    )
+                    urls = [url for url, _ in page_articles]
+                    if frontier in urls:
+                        page_articles = page_articles[: urls.index(frontier)]
+                        stop = True
+                    else:
+                        last_url, last_title = page_articles[-1]
+                        stop = last_title == "1月21日新型冠状病毒感染的肺炎疫情情况" or (
+                            not full and last_url in stored_urls([last_url])
+                        )
+                    articles.extend(page_articles)
+                if stop:
+                    stored = stored_urls(url for url, _ in articles)
+                    logger.info(f"crawled {len(index_pages)} index pages")
+                    return (
+                        [a for a in reversed(articles) if a[0] not in stored],
+                        index_pages,
+                    )
+        finally:
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=False)
+        page += window
+        window = jobs
+
+
+def save_index_pages(index_pages):
+    with database.atomic():
+        for row in index_pages:
+            IndexPage.replace(**row).execute()
+
+
+def extract_article(dom):
+    s = bs4.BeautifulSoup(dom, "html.parser")
+    title = s.select_one(".tit").get_text().strip()
+    body_container = s.select_one("#xw_box")
+    body_container.select_one(".fx").extract()
+    for p in body_container.select("p[style]"):
+        if "text-align: right" in p["style"].lower():
+            p.extract()
+    body = body_container.get_text().strip()
+    return title, body
 
 
 @network_retry
 def get_article(url):
-    with fetch_dom(url) as dom:
-        s = bs4.BeautifulSoup(dom, "html.parser")
-        title = s.select_one(".tit").get_text().strip()
-        body_container = s.select_one("#xw_box")
-        body_container.select_one(".fx").extract()
-        for p in body_container.select("p[style]"):
-            if "text-align: right" in p["style"].lower():
-                p.extract()
-        body = body_container.get_text().strip()
+    with fetch_dom(url, ready_selector="#xw_box") as dom:
+        with metrics.span("dom_parse", page="article"):
+            title, body = extract_article(dom)
     print(title)
     print(body)
     return title, body
@@ -245,6 +627,9 @@ introduced = {
 }
 
 
+extractor = Extractor(patterns, negative_patterns)
+
+
 def parse_article(title, body):
     m = title_pattern.match(title)
     month = int(m["month"])
@@ -257,130 +642,226 @@ def parse_article(title, body):
     date_str = f"{month:02}-{day:02}"
     print(date_str)
     data = dict(date=date)
+    with metrics.span("extract", source="nhc"):
+        counts = extractor.extract(body)
     for category, pattern in patterns.items():
-        if m := re.search(pattern, body, re.M):
-            if m[category]:
-                count = int(m[category])
-            else:
-                count = int(m[f"{category}2"])
-            data[category] = count
-            print(f"{count}\t{category}")
-            continue
-        elif category in negative_patterns and (
-            m := re.search(negative_patterns[category], body, re.M)
-        ):
-            if m[category]:
-                count = -int(m[category])
-            else:
-                count = -int(m[f"{category}2"])
-            data[category] = count
+        if category in counts:
+            count = data[category] = counts[category]
             print(f"{count}\t{category}")
             continue
         if category in introduced and date_str < introduced[category]:
             continue
+        metrics.inc("match_misses_total", source="nhc", category=category)
         logger.critical(f"{date}: no match for {category}: {pattern!r}")
     return data
 
 
+def fetcher_argument(value):
+    host, _, name = value.rpartition("=")
+    if name not in FETCHERS:
+        raise argparse.ArgumentTypeError(
+            f"unknown fetcher {name!r} (choose from {', '.join(FETCHERS)})"
+        )
+    return host, name
+
+
+def add_fetch_arguments(parser):
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"number of pages to fetch concurrently (default: {DEFAULT_JOBS})",
+    )
+    parser.add_argument(
+        "--fetcher",
+        type=fetcher_argument,
+        action="append",
+        default=[],
+        metavar="[HOST=]NAME",
+        help=f"fetch pages of HOST (or without HOST, of hosts not given a fetcher "
+        f"of their own) with fetcher NAME: {', '.join(FETCHERS)} "
+        f"(default: {DEFAULT_FETCHER}, "
+        + ", ".join(f"{name} for {host}" for host, name in SITE_FETCHERS.items())
+        + ")",
+    )
+    parser.add_argument(
+        "--mirror",
+        metavar="DIR",
+        help="serve pages from DIR/<host>/<path> instead of fetching them",
+    )
+    parser.add_argument(
+        "--host-interval",
+        type=float,
+        default=HOST_INTERVAL,
+        help="minimum interval in seconds between requests to the same host "
+        f"(default: {HOST_INTERVAL})",
+    )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        "--offline",
+        action="store_true",
+        help="serve pages from the page cache only, never touching the network",
+    )
+    cache_group.add_argument(
+        "--no-cache", action="store_true", help="do not save fetched pages to the cache"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE // 1024 // 1024,
+        metavar="MB",
+        help="maximum size of the page cache before old pages are evicted "
+        f"(default: {DEFAULT_MAX_SIZE // 1024 // 1024})",
+    )
+
+
+def configure_fetching(args):
+    global default_fetcher, mirror_root, page_cache, offline
+    for host, name in args.fetcher:
+        if host:
+            site_fetchers[host] = name
+        else:
+            default_fetcher = name
+    if args.mirror:
+        mirror_root = args.mirror
+    rate_limiter.interval = args.host_interval
+    if not args.no_cache:
+        page_cache = PageCache(cachedir, max_size=args.cache_size * 1024 * 1024)
+    offline = args.offline
+
+
 def main():
-    recorded_urls = set(entry.article_url for entry in DataEntry.select())
-    articles = get_article_list(recorded_urls)
-    for url, _ in articles:
-        if url in recorded_urls:
-            continue
-        title, body = get_article(url)
+    parser = argparse.ArgumentParser()
+    add_fetch_arguments(parser)
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="walk the whole index for articles not stored yet, instead of "
+        "stopping at the newest article seen by the last run",
+    )
+    parser.add_argument(
+        "--full-export",
+        action="store_true",
+        help=f"rewrite {datafile.name} even if no row changed since the last export",
+    )
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    configure_fetching(args)
+    metrics.configure(args.metrics_jsonl, args.metrics_textfile)
+
+    init_database()
+    articles, index_pages = get_article_list(jobs=args.jobs, full=args.full)
+    new_urls = [url for url, _ in articles]
+    # Fetch concurrently, but insert in chronological order, all in one
+    # transaction once every article has been fetched and parsed.
+    entries = []
+    stats = []
+    for url, (title, body) in zip(
+        new_urls, fetch_many(get_article, new_urls, jobs=args.jobs)
+    ):
         data = parse_article(title, body)
-        data.update(
-            article_url=url, article_title=title, article_body=body,
+        entries.append(
+            dict(
+                date=data["date"],
+                article_url=url,
+                article_title=title,
+                article_body=body,
+            )
         )
-        DataEntry.create(**data)
+        stats.extend(stat_rows(data["date"], data))
+    close_fetchers()
+    with metrics.span("db_write"), database.atomic():
+        save_articles(entries)
+        save_stats(stats)
+        save_index_pages(index_pages)
+    metrics.inc("articles_stored_total", len(entries))
 
-    with datafile.open("w") as fp:
-        writer = csv.writer(fp)
-        writer.writerow(
-            [
-                "日期",
-                "累计确诊",
-                "当前确诊",
-                "当前重症",
-                "当前疑似",
-                "治愈",
-                "死亡",
-                "新确诊",
-                "新重症",
-                "新疑似",
-                "新治愈",
-                "新死亡",
-                "累计追踪",
-                "新排除",
-                "当前观察",
-                "湖北累计确诊",
-                "湖北当前确诊",
-                "湖北当前重症",
-                "湖北当前疑似",
-                "湖北治愈",
-                "湖北死亡",
-                "湖北新确诊",
-                "湖北新重症",
-                "湖北新疑似",
-                "湖北新治愈",
-                "湖北新死亡",
-                "非湖北累计确诊",
-                "非湖北当前确诊",
-                "非湖北当前重症",
-                "非湖北当前疑似",
-                "非湖北治愈",
-                "非湖北死亡",
-                "非湖北新确诊",
-                "非湖北新重症",
-                "非湖北新疑似",
-                "非湖北新治愈",
-                "非湖北新死亡",
+    export_csv(incremental=not args.full_export)
+
+
+def format_csv_row(row):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue()
+
+
+def row_digest(line):
+    return hashlib.sha1(line.encode("utf-8")).hexdigest()
+
+
+def load_manifest():
+    try:
+        return json.loads(manifestfile.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# Export data.csv. Rows are serialized and hashed in memory and compared to
+# the manifest of the previous export; when incremental and nothing changed
+# (and data.csv is still the file we wrote), data.csv is not touched at all.
+# Otherwise it is replaced atomically.
+def export_csv(incremental=True):
+    with metrics.span("db_read"):
+        stats = load_stats()
+    table = derived.labeled(derived.derive(stats))
+    # Missing values are written as empty fields.
+    frame = table.astype(object).where(table.notna(), None)
+
+    header = format_csv_row(derived.CSV_HEADER)
+    lines = {}
+    for date, *values in frame.itertuples(name=None):
+        date = date.strftime("%Y-%m-%d")
+        lines[date] = format_csv_row([date, *values])
+    rows = {date: row_digest(line) for date, line in lines.items()}
+    manifest = dict(
+        header=row_digest(header),
+        last_date=max(rows, default=None),
+        rows=rows,
+        size=None,
+        mtime_ns=None,
+    )
+
+    previous = load_manifest() if incremental else None
+    if previous and previous["header"] == manifest["header"]:
+        try:
+            stat = datafile.stat()
+            untouched = (stat.st_size, stat.st_mtime_ns) == (
+                previous["size"],
+                previous["mtime_ns"],
+            )
+        except FileNotFoundError:
+            untouched = False
+        if untouched:
+            old_rows = previous["rows"]
+            appended = [date for date in rows if date not in old_rows]
+            changed = [
+                date
+                for date, digest in rows.items()
+                if date in old_rows and old_rows[date] != digest
             ]
-        )
-        for entry in list(DataEntry.select().order_by(DataEntry.date)):
-            writer.writerow(
-                [
-                    entry.date.strftime("%Y-%m-%d"),
-                    entry.total_confirmed,
-                    entry.remaining_confirmed_calc,
-                    entry.remaining_severe,
-                    entry.remaining_suspected,
-                    entry.cured,
-                    entry.death,
-                    entry.new_confirmed,
-                    entry.new_severe,
-                    entry.new_suspected,
-                    entry.new_cured,
-                    entry.new_death,
-                    entry.total_tracked,
-                    entry.new_lifted,
-                    entry.remaining_quarantined,
-                    entry.hb_total_confirmed,
-                    entry.hb_remaining_confirmed,
-                    entry.hb_remaining_severe,
-                    entry.hb_remaining_suspected,
-                    entry.hb_cured,
-                    entry.hb_death,
-                    entry.hb_new_confirmed,
-                    entry.hb_new_severe_calc,
-                    entry.hb_new_suspected,
-                    entry.hb_new_cured,
-                    entry.hb_new_death,
-                    entry.not_hb_total_confirmed,
-                    entry.not_hb_remaining_confirmed,
-                    entry.not_hb_remaining_severe,
-                    entry.not_hb_remaining_suspected,
-                    entry.not_hb_cured,
-                    entry.not_hb_death,
-                    entry.not_hb_new_confirmed,
-                    entry.not_hb_new_severe,
-                    entry.not_hb_new_suspected,
-                    entry.not_hb_new_cured,
-                    entry.not_hb_new_death,
-                ]
+            removed = [date for date in old_rows if date not in rows]
+            if not appended and not changed and not removed:
+                logger.info(f"{datafile.name} is up to date")
+                if not derived.npy_is_current(npyfile, datafile):
+                    with metrics.span("npy_write"):
+                        derived.save_npy(table, npyfile)
+                return
+            logger.info(
+                f"{datafile.name}: {len(appended)} rows appended, "
+                f"{len(changed)} rows updated, {len(removed)} rows removed"
             )
 
+    with metrics.span("csv_write"):
+        atomic_write_text(datafile, header + "".join(lines.values()))
+        stat = datafile.stat()
+        manifest.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        atomic_write_text(manifestfile, json.dumps(manifest, indent=2) + "\n")
+    # Written after data.csv, so that it is only current (see
+    # derived.npy_is_current) once it matches the new data.csv.
+    with metrics.span("npy_write"):
+        derived.save_npy(table, npyfile)
+
 
 if __name__ == "__main__":
     main()
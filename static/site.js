@@ -0,0 +1,148 @@
+// Behavior of the static export (see export_static.py): loads the figure or
+// table of a tab when it is selected, pages tables, and zooms figures to the
+// selected date range.
+(function () {
+  "use strict";
+
+  var config = JSON.parse(
+    document.getElementById("static-config").textContent
+  );
+  var cache = {};
+  var dateRange = [null, null];
+
+  function fetchJSON(path) {
+    if (!cache[path]) {
+      cache[path] = fetch(path).then(function (response) {
+        if (!response.ok) {
+          throw new Error(path + ": HTTP " + response.status);
+        }
+        return response.json();
+      });
+    }
+    return cache[path];
+  }
+
+  // Call onSelect with the value of the selected tab now and whenever another
+  // tab of the group is selected.
+  function setUpTabs(groupId, onSelect) {
+    var container = document.getElementById(groupId + "-tabs");
+    var buttons = container.querySelectorAll(".static-tab");
+    var selected = container.querySelector(".app-tab--selected");
+    Array.prototype.forEach.call(buttons, function (button) {
+      button.addEventListener("click", function () {
+        if (button === selected) {
+          return;
+        }
+        selected.classList.remove("app-tab--selected");
+        button.classList.add("app-tab--selected");
+        selected = button;
+        onSelect(button.dataset.value);
+      });
+    });
+    onSelect(selected.dataset.value);
+  }
+
+  function xRange() {
+    if (!dateRange[0] && !dateRange[1]) {
+      return { "xaxis.autorange": true };
+    }
+    var start = dateRange[0] || "2020-01-01";
+    var end = dateRange[1] || new Date().toISOString().slice(0, 10);
+    return { "xaxis.range": [start, end] };
+  }
+
+  function setUpFigures(groupId) {
+    var content = document.getElementById(groupId + "-content");
+    var current = null;
+    setUpTabs(groupId, function (value) {
+      current = value;
+      fetchJSON(config.figures[value]).then(function (graph) {
+        if (current !== value) {
+          return;
+        }
+        var options = Object.assign({ responsive: true }, graph.config);
+        Plotly.react(content, graph.figure.data, graph.figure.layout, options);
+        Plotly.relayout(content, xRange());
+      });
+    });
+    document.addEventListener("static:daterange", function () {
+      if (content.data) {
+        Plotly.relayout(content, xRange());
+      }
+    });
+  }
+
+  function cell(tag, text) {
+    var element = document.createElement(tag);
+    element.textContent = text === null ? "" : text;
+    return element;
+  }
+
+  function renderTablePage(container, table, page) {
+    var pageSize = config.tablePageSize;
+    var pageCount = Math.max(1, Math.ceil(table.dates.length / pageSize));
+    page = Math.min(Math.max(page, 0), pageCount - 1);
+    var start = page * pageSize;
+    var end = start + pageSize;
+
+    var element = document.createElement("table");
+    var head = element.createTHead().insertRow();
+    head.appendChild(cell("th", ""));
+    table.dates.slice(start, end).forEach(function (date) {
+      head.appendChild(cell("th", date));
+    });
+    var body = element.createTBody();
+    table.rows.forEach(function (row) {
+      var tr = body.insertRow();
+      tr.appendChild(cell("td", row[0]));
+      row.slice(1 + start, 1 + end).forEach(function (value) {
+        tr.appendChild(cell("td", value));
+      });
+    });
+
+    var pager = document.createElement("div");
+    pager.className = "static-pager";
+    var previous = cell("button", "<");
+    previous.disabled = page === 0;
+    previous.addEventListener("click", function () {
+      renderTablePage(container, table, page - 1);
+    });
+    var next = cell("button", ">");
+    next.disabled = page === pageCount - 1;
+    next.addEventListener("click", function () {
+      renderTablePage(container, table, page + 1);
+    });
+    pager.appendChild(previous);
+    pager.appendChild(cell("span", page + 1 + " / " + pageCount));
+    pager.appendChild(next);
+
+    container.replaceChildren(element, pager);
+  }
+
+  function setUpTables() {
+    var container = document.getElementById("table");
+    var current = null;
+    setUpTabs("tables", function (value) {
+      current = value;
+      fetchJSON(config.tables[value]).then(function (table) {
+        if (current === value) {
+          renderTablePage(container, table, 0);
+        }
+      });
+    });
+  }
+
+  function setUpDateRange() {
+    ["start", "end"].forEach(function (which, i) {
+      var input = document.getElementById("date-range-" + which);
+      input.addEventListener("change", function () {
+        dateRange[i] = input.value || null;
+        document.dispatchEvent(new Event("static:daterange"));
+      });
+    });
+  }
+
+  setUpTables();
+  config.figureGroups.forEach(setUpFigures);
+  setUpDateRange();
+})();
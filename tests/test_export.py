@@ -0,0 +1,49 @@
+import datetime
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import derived  # noqa: E402
+import scraper  # noqa: E402
+
+
+# Export ndays of stats from a new database in workdir and return the number
+# of SQL statements executed by the export.
+def export_query_count(workdir, ndays, monkeypatch):
+    workdir.mkdir()
+    monkeypatch.setattr(scraper, "datafile", workdir / "data.csv")
+    monkeypatch.setattr(scraper, "manifestfile", workdir / "data.csv.manifest.json")
+    monkeypatch.setattr(scraper, "npyfile", workdir / "data.npy")
+    scraper.init_database(workdir / "data.db")
+    try:
+        first = datetime.date(2020, 1, 20)
+        rows = []
+        for i in range(ndays):
+            data = {name: i for name in derived.RAW_FIELDS}
+            rows.extend(scraper.stat_rows(first + datetime.timedelta(i), data))
+        scraper.save_stats(rows)
+
+        queries = []
+        execute_sql = scraper.database.execute_sql
+
+        def counting_execute_sql(sql, *args, **kwargs):
+            queries.append(sql)
+            return execute_sql(sql, *args, **kwargs)
+
+        with monkeypatch.context() as m:
+            m.setattr(scraper.database, "execute_sql", counting_execute_sql)
+            scraper.export_csv(incremental=False)
+    finally:
+        scraper.database.close()
+    assert len(scraper.datafile.read_text().splitlines()) == ndays + 1
+    return len(queries)
+
+
+def test_export_queries_do_not_grow_with_days(tmp_path, monkeypatch):
+    counts = [
+        export_query_count(tmp_path / str(ndays), ndays, monkeypatch)
+        for ndays in (10, 20)
+    ]
+    assert counts[0] > 0
+    assert counts[0] == counts[1]